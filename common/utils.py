@@ -1,3 +1,9 @@
+import functools
+import re
+
+from titlecase import titlecase
+
+
 def nhs_abbreviations(word, **kwargs):
     if len(word) == 2 and word.lower() not in [
         "at",
@@ -24,8 +30,11 @@ def nhs_abbreviations(word, **kwargs):
         return word.upper()
 
 
+# Titlecasing runs several regexes per word, and the same names are shown
+# over and over, so remember the results for the most recent names
+@functools.lru_cache(maxsize=20000)
 def nhs_titlecase(words):
     if words:
         title_cased = titlecase(words, callback=nhs_abbreviations)
-        words = re.sub(r"Dr ([a-z]{2})", "Dr \1", title_cased)
+        words = re.sub(r"Dr ([a-z]{2})", r"Dr \1", title_cased)
     return words
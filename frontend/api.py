@@ -0,0 +1,170 @@
+"""JSON endpoints listing measures, groups and the charts available for them,
+and searching practices and groups.
+
+Listings are streamed, one result at a time, and carry an ETag derived from
+the data version and the chart index, so clients can cheaply re-validate.
+Pass `page` (and optionally `page_size`) to get one page of a listing rather
+than all of it.
+
+"""
+import hashlib
+import json
+from urllib.parse import urlencode
+
+from django.http import Http404
+from django.http import HttpResponseBadRequest
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.http import etag
+
+from frontend.charts import DEFAULT_SORT
+from frontend.charts import get_chart_index
+from frontend.models import DataVersion
+from frontend.models import Group
+from frontend.models import Measure
+from frontend.models import Practice
+from frontend.search import get_search_index
+from frontend.views import chart_src
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+
+
+def _data_etag(request, *args, **kwargs):
+    return hashlib.md5(
+        "{}:{}:{}".format(
+            DataVersion.current(), get_chart_index().signature, request.get_full_path()
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def _stream_json(count, results, next_page):
+    yield '{{"count": {}, "next": {}, "results": ['.format(count, json.dumps(next_page))
+    for i, result in enumerate(results):
+        if i:
+            yield ", "
+        yield json.dumps(result)
+    yield "]}"
+
+
+def _listing_response(request, items, serialise):
+    """Return a streaming JSON response listing `items`, paged if a `page`
+    was requested
+
+    """
+    count = len(items)
+    next_page = None
+    if "page" in request.GET:
+        try:
+            page = int(request.GET["page"])
+            page_size = min(
+                int(request.GET.get("page_size", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE
+            )
+        except ValueError:
+            return HttpResponseBadRequest("page and page_size must be integers")
+        if page < 1 or page_size < 1:
+            return HttpResponseBadRequest("page and page_size must be positive")
+        start = (page - 1) * page_size
+        if start + page_size < count:
+            query = request.GET.copy()
+            query["page"] = page + 1
+            next_page = request.build_absolute_uri("?" + query.urlencode())
+        items = items[start : start + page_size]
+    results = (serialise(item) for item in items)
+    return StreamingHttpResponse(
+        _stream_json(count, results, next_page), content_type="application/json"
+    )
+
+
+def _serialise_chart(chart):
+    return {
+        "measure_id": chart.measure_id,
+        "practice_code": "ods/{}".format(chart.practice_code),
+        "rank": chart.rank,
+        "url": chart_src(chart),
+    }
+
+
+@etag(_data_etag)
+def measures(request):
+    measures = list(
+        Measure.objects.order_by("pk").values("id", "title", "why_it_matters")
+    )
+    return _listing_response(request, measures, lambda measure: measure)
+
+
+@etag(_data_etag)
+def groups(request):
+    return _listing_response(request, Group.objects.navigation(), lambda group: group)
+
+
+@etag(_data_etag)
+def measure_charts(request, measure):
+    """List a measure's charts in rank order, or the order given by `sort`,
+    narrowed down by any `filter` entity codes
+
+    """
+    measure = get_object_or_404(Measure, pk=measure)
+    sort = request.GET.get("sort", DEFAULT_SORT)
+    if sort not in get_chart_index().sort_orders:
+        return HttpResponseBadRequest(
+            "sort must be one of {}".format(", ".join(get_chart_index().sort_orders))
+        )
+    practice_codes = Practice.objects.membership().practice_codes(
+        request.GET.getlist("filter")
+    )
+    charts = measure.charts(ods_practice_codes=practice_codes, sort=sort)
+    return _listing_response(request, charts, _serialise_chart)
+
+
+@etag(_data_etag)
+def practice_charts(request, practice):
+    """List the charts for every measure for one practice, in rank order
+    """
+    system, _, ods_code = practice.partition("/")
+    membership = Practice.objects.membership()
+    if system != "ods" or ods_code not in membership.practice_ids_by_ods_code:
+        raise Http404("No practice with code {}".format(practice))
+    charts = get_chart_index().for_practices([ods_code])
+    return _listing_response(request, charts, _serialise_chart)
+
+
+def _serialise_search_result(result, measure=None):
+    if result.kind == "practice":
+        url = reverse("practice", kwargs={"practice": result.code})
+    elif measure:
+        url = "{}?{}".format(
+            reverse("measure", kwargs={"measure": measure.id}),
+            urlencode({"filter": result.code}),
+        )
+    else:
+        url = None
+    return {"name": result.name, "kind": result.kind, "code": result.code, "url": url}
+
+
+@etag(_data_etag)
+def search(request):
+    """Find practices and groups whose names or codes start with the words in
+    `q`, for typeahead.
+
+    Practices link to their pages, and groups to the page for `measure`
+    filtered to their practices, if a `measure` is given.
+
+    """
+    try:
+        limit = int(request.GET.get("limit", DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        return HttpResponseBadRequest("limit must be an integer")
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+    measure = None
+    if request.GET.get("measure"):
+        measure = get_object_or_404(Measure, pk=request.GET["measure"])
+    results = get_search_index().search(request.GET.get("q", ""), limit)
+    return JsonResponse(
+        {"results": [_serialise_search_result(result, measure) for result in results]}
+    )
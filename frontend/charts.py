@@ -0,0 +1,541 @@
+"""An in-memory index of the pregenerated chart images.
+
+Chart files live in `PREGENERATED_CHARTS_ROOT` and are named
+`<measure_id>_<ods_practice_code>_<sort_key>.png`. Rather than globbing
+the directory on every request, we scan it once, and again whenever it
+changes (see `get_chart_index`), and keep the charts grouped by measure and
+by practice, already in sort key order.
+
+`./manage.py optimise_charts` also writes smaller derivatives of each
+chart next to it (see `derivative_name`), and records them in a manifest
+which the index uses to offer responsive image sources.
+Charts, their derivatives and atlases are served at URLs derived from their
+content (see `ChartIndex.file_hash`), which only change when the image does,
+rather than at their filenames, which include a rank that changes between
+data releases. Content hashes are worked out when the index is built. Those
+of charts recorded by `optimise_charts`, or by the previous index, are
+reused for files that haven't changed since; those of derivatives and
+atlases are recorded by the commands that write them.
+`./manage.py build_chart_atlases` packs each measure's charts into a few
+atlas images in `ATLAS_DIR`, with a manifest giving each chart's tile.
+
+A chart drop may come with a metadata manifest, `METADATA_MANIFEST`,
+mapping each chart's filename to its `measure_id`, `practice_code` and
+`rank`, plus any other keys to sort by (such as `practice_name`, `ccg` or
+`latest_value`):
+
+    {"charts": {"liver_A81001_3.png": {"measure_id": "liver",
+                                       "practice_code": "A81001",
+                                       "rank": 3,
+                                       "latest_value": 0.4}}}
+
+Charts it doesn't list, or lists without a valid `measure_id`,
+`practice_code` and `rank`, fall back to the details in their filenames.
+Each measure's charts are put in every available sort order (see
+`ChartIndex.sort_orders`) when the index is built.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from collections import namedtuple
+
+from django.conf import settings
+
+from frontend.instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+CHART_FILENAME_RE = re.compile(
+    r"^(?P<measure_id>.+)_(?P<practice_code>[^_]+)_(?P<rank>\d+)\.png$"
+)
+
+Chart = namedtuple("Chart", ["measure_id", "practice_code", "rank", "url"])
+
+OPTIMISED_MANIFEST = ".optimised.json"
+METADATA_MANIFEST = ".charts.json"
+ATLAS_DIR = "atlases"
+DEFAULT_SORT = "rank"
+# Characters of a chart's SHA-256 used in its URL
+CONTENT_HASH_LENGTH = 16
+
+
+def derivative_name(url, width=None, image_format="png"):
+    """Return the filename of a derivative of the chart at `url`, resized to
+    `width` pixels wide and/or converted to `image_format`
+
+    """
+    stem = url[: -len(".png")]
+    if width:
+        return "{}.{}w.{}".format(stem, width, image_format)
+    return "{}.{}".format(stem, image_format)
+
+
+def directory_generation(root):
+    """Return the modification times of the chart directory and its atlas
+    directory, which change whenever a file in them is added, removed, or
+    replaced by renaming a new file over it
+
+    """
+    generation = []
+    for path in (root, os.path.join(root, ATLAS_DIR)):
+        try:
+            generation.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            generation.append(None)
+    return tuple(generation)
+
+
+def _file_hash(path):
+    """Return the content hash of the file at `path`, and the size and
+    modification time of the file that was hashed
+    """
+    with open(path, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()[:CONTENT_HASH_LENGTH]
+        return content_hash, file_stat(f)
+
+
+def file_stat(f):
+    """Return the size and modification time of an open file
+    """
+    stat = os.fstat(f.fileno())
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _path_stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _load_manifest(path):
+    """Return the JSON object in the file at `path`, or an empty dict if
+    there's no such file or it doesn't hold a JSON object
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.exception("Ignoring %s, which isn't valid JSON", path)
+        return {}
+    if not isinstance(manifest, dict):
+        logger.error("Ignoring %s, which doesn't hold a JSON object", path)
+        return {}
+    return manifest
+
+
+def _chart_from_fields(filename, fields):
+    """Return the Chart described by a metadata manifest entry, or None if
+    any of the fields a chart needs is missing or invalid
+    """
+    measure_id = fields.get("measure_id")
+    practice_code = fields.get("practice_code")
+    rank = fields.get("rank")
+    if isinstance(rank, str) and rank.isdigit():
+        rank = int(rank)
+    if (
+        not (isinstance(measure_id, str) and measure_id)
+        or not (isinstance(practice_code, str) and practice_code)
+        or not isinstance(rank, int)
+        or isinstance(rank, bool)
+    ):
+        return None
+    return Chart(
+        measure_id=measure_id, practice_code=practice_code, rank=rank, url=filename
+    )
+
+
+def _chart_from_filename(filename):
+    """Return the Chart described by a chart's filename, or None if it
+    isn't a chart's filename
+    """
+    match = CHART_FILENAME_RE.match(filename)
+    if not match:
+        return None
+    return Chart(
+        measure_id=match.group("measure_id"),
+        practice_code=match.group("practice_code"),
+        rank=int(match.group("rank")),
+        url=filename,
+    )
+
+
+def _sort_kind(value):
+    """Return which values `value` can be sorted among: numbers, strings or
+    booleans, or None if it can't be sorted
+    """
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, float)):
+        return float
+    if isinstance(value, str):
+        return str
+    return None
+
+
+def _sort_key(chart):
+    return (chart.rank, chart.url)
+
+
+def _ordered(charts, value, descending=False):
+    """Return charts sorted by `value(chart)`, in sort key order where
+    values are equal, and with charts that have no value last
+
+    """
+    charts = sorted(charts, key=_sort_key)
+    present = [chart for chart in charts if value(chart) is not None]
+    missing = [chart for chart in charts if value(chart) is None]
+    return sorted(present, key=value, reverse=descending) + missing
+
+
+class ChartIndex:
+    """Charts found in a directory, keyed by measure id and by practice code.
+
+    If given, the `previous` index of the same directory is used to avoid
+    rehashing charts that haven't changed since it was built.
+
+    """
+
+    def __init__(self, root, previous=None):
+        self.root = root
+        # Taken before scanning, so that changes made during the scan are
+        # picked up by the next check
+        self.generation = directory_generation(root)
+        self.next_check = 0
+        charts = []
+        self.stats = {}
+        listed = _load_manifest(os.path.join(root, METADATA_MANIFEST)).get("charts")
+        if not isinstance(listed, dict):
+            listed = {}
+        self.metadata = {}
+        if os.path.isdir(root):
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    fields = listed.get(entry.name)
+                    if not isinstance(fields, dict):
+                        fields = {}
+                    chart = _chart_from_fields(entry.name, fields)
+                    if chart is None:
+                        chart = _chart_from_filename(entry.name)
+                    if chart is None or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    self.stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                    if fields:
+                        self.metadata[entry.name] = {
+                            key: value
+                            for key, value in fields.items()
+                            if key not in Chart._fields
+                        }
+                    charts.append(chart)
+        charts.sort(key=_sort_key)
+        self.charts = charts
+        # Charts missing from the manifests are served as they are
+        self.optimised = {
+            url: optimised
+            for url, optimised in _load_manifest(
+                os.path.join(root, OPTIMISED_MANIFEST)
+            ).items()
+            if isinstance(optimised, dict)
+        }
+        self.atlases = {}
+        atlas_dir = os.path.join(root, ATLAS_DIR)
+        if os.path.isdir(atlas_dir):
+            for filename in sorted(os.listdir(atlas_dir)):
+                if filename.endswith(".json"):
+                    atlas = _load_manifest(os.path.join(atlas_dir, filename))
+                    if atlas:
+                        self.atlases[filename[: -len(".json")]] = atlas
+        # The content hashes of the files served from the directory, and
+        # the sizes and modification times of the files that were hashed, by
+        # filename
+        self._content_hashes = {}
+        self._hashed_stats = {}
+        for chart in charts:
+            content_hash = self._known_content_hash(chart, previous)
+            if content_hash is None:
+                content_hash, stat = _file_hash(os.path.join(root, chart.url))
+                self.stats[chart.url] = stat
+            self._content_hashes[chart.url] = content_hash
+            self._hashed_stats[chart.url] = self.stats[chart.url]
+            # Derivatives are only used while they and the chart they were
+            # made from are unchanged
+            optimised = self.optimised.get(chart.url)
+            if optimised and tuple(optimised.get("stat", ())) == self.stats[chart.url]:
+                stem = chart.url[: -len("png")]
+                derivative_stats = optimised.get("derivative_stats", {})
+                for suffix, digest in optimised.get("derivatives", {}).items():
+                    stat = _path_stat(os.path.join(root, stem + suffix))
+                    if stat and list(stat) == derivative_stats.get(suffix):
+                        self._content_hashes[stem + suffix] = digest[
+                            :CONTENT_HASH_LENGTH
+                        ]
+                        self._hashed_stats[stem + suffix] = stat
+        for atlas in self.atlases.values():
+            for url, digest, recorded_stat in zip(
+                atlas["atlases"], atlas.get("sha256s", []), atlas.get("stats", [])
+            ):
+                stat = _path_stat(os.path.join(root, url))
+                if stat and list(stat) == recorded_stat:
+                    self._content_hashes[url] = digest[:CONTENT_HASH_LENGTH]
+                    self._hashed_stats[url] = stat
+        self._files_by_content_hash = {}
+        for filename, content_hash in self._content_hashes.items():
+            self._files_by_content_hash.setdefault(content_hash, filename)
+        # Changes whenever a chart is added, removed, re-ranked, replaced,
+        # optimised or packed into an atlas, so it can be used in cache keys
+        signature = hashlib.md5()
+        for chart in charts:
+            signature.update(chart.url.encode("utf-8"))
+            signature.update(repr(self.stats[chart.url]).encode("utf-8"))
+            signature.update(repr(self.optimised.get(chart.url)).encode("utf-8"))
+            signature.update(repr(self.atlas_tile(chart)).encode("utf-8"))
+            signature.update(
+                json.dumps(self.metadata.get(chart.url), sort_keys=True).encode("utf-8")
+            )
+        self.signature = signature.hexdigest()
+        self.by_measure = {}
+        self.by_practice = {}
+        self.by_measure_and_practice = {}
+        for chart in charts:
+            self.by_measure.setdefault(chart.measure_id, []).append(chart)
+            self.by_practice.setdefault(chart.practice_code, []).append(chart)
+            self.by_measure_and_practice[
+                (chart.measure_id, chart.practice_code)
+            ] = chart
+        # Each measure's charts in every sort order, keyed by sort order
+        # then measure id. A sort order is `rank` or a metadata key, with a
+        # leading "-" for descending order.
+        sort_keys = sorted({key for fields in self.metadata.values() for key in fields})
+        # Values of different types can't be compared, so each key is sorted
+        # by the values of its commonest type, and charts with values of
+        # other types are treated as having none
+        self._sort_kinds = {}
+        for key in sort_keys:
+            kinds = Counter(
+                _sort_kind(fields.get(key)) for fields in self.metadata.values()
+            )
+            del kinds[None]
+            self._sort_kinds[key] = kinds.most_common(1)[0][0] if kinds else None
+        self.sort_orders = []
+        self.by_sort_order = {}
+        for key in ["rank"] + sort_keys:
+            value = self._value_getter(key)
+            for descending in (False, True):
+                sort_order = "-" + key if descending else key
+                self.sort_orders.append(sort_order)
+                self.by_sort_order[sort_order] = {
+                    measure_id: _ordered(measure_charts, value, descending)
+                    for measure_id, measure_charts in self.by_measure.items()
+                }
+
+    def __len__(self):
+        return len(self.charts)
+
+    def _value_getter(self, key):
+        if key == "rank":
+            return lambda chart: chart.rank
+        kind = self._sort_kinds[key]
+
+        def value(chart):
+            value = self.metadata.get(chart.url, {}).get(key)
+            return value if _sort_kind(value) == kind else None
+
+        return value
+
+    def _ordered(self, charts, sort_order):
+        key = sort_order.lstrip("-")
+        return _ordered(
+            charts, self._value_getter(key), descending=sort_order.startswith("-")
+        )
+
+    def _known_content_hash(self, chart, previous):
+        """Return the hash of a chart's image recorded by the `previous`
+        index or by `optimise_charts`, or None if neither has one for the
+        file as it is now
+        """
+        stat = self.stats[chart.url]
+        if previous is not None and previous.stats.get(chart.url) == stat:
+            return previous._content_hashes[chart.url]
+        optimised = self.optimised.get(chart.url)
+        if optimised and tuple(optimised.get("stat", ())) == stat:
+            return optimised["sha256"][:CONTENT_HASH_LENGTH]
+        return None
+
+    def content_hash(self, chart):
+        """Return a hash of the chart's image
+        """
+        return self._content_hashes[chart.url]
+
+    def file_hash(self, filename):
+        """Return a hash of the content of a chart, derivative or atlas, given
+        its filename relative to the chart directory, or None if it isn't
+        one that's served
+        """
+        return self._content_hashes.get(filename)
+
+    def file_for_content_hash(self, content_hash):
+        """Return the filename, relative to the chart directory, of a chart,
+        derivative or atlas with the given content hash, or None
+        """
+        return self._files_by_content_hash.get(content_hash)
+
+    def is_unchanged(self, filename, f):
+        """Return whether the open file `f` is the one whose content was
+        hashed as `filename`. If not, the directory is scanned again on the
+        next lookup, as a file rewritten in place doesn't change the
+        directory's modification time.
+        """
+        if file_stat(f) == self._hashed_stats.get(filename):
+            return True
+        self.generation = None
+        self.next_check = 0
+        return False
+
+    def atlas_tile(self, chart):
+        """Return where a chart is in its measure's atlas, as a dict with the
+        atlas `url` and the tile's `x`, `y`, `width` and `height`, or None
+        if it isn't in an up-to-date atlas
+
+        """
+        atlas = self.atlases.get(chart.measure_id)
+        if not atlas:
+            return None
+        tile = atlas["tiles"].get(chart.url)
+        if not tile or tuple(tile["stat"]) != self.stats.get(chart.url):
+            return None
+        url = atlas["atlases"][tile["atlas"]]
+        if url not in self._content_hashes:
+            return None
+        return {
+            "url": url,
+            "x": tile["x"],
+            "y": tile["y"],
+            "width": tile["width"],
+            "height": tile["height"],
+        }
+
+    def srcsets(self, chart):
+        """Return the responsive sources for a chart, as a dict of image
+        format to a list of (url, width) tuples, or None if the chart has
+        no up-to-date derivatives
+
+        """
+        optimised = self.optimised.get(chart.url)
+        if not optimised:
+            return None
+        widths = optimised["widths"]
+        png = [(derivative_name(chart.url, width), width) for width in widths]
+        png.append((chart.url, optimised["width"]))
+        webp = [(derivative_name(chart.url, width, "webp"), width) for width in widths]
+        webp.append(
+            (derivative_name(chart.url, image_format="webp"), optimised["width"])
+        )
+        if any(url not in self._content_hashes for url, width in png + webp):
+            return None
+        return {"png": png, "webp": webp}
+
+    def for_measure(self, measure_id, practice_codes=None, sort=DEFAULT_SORT):
+        """Return charts for a measure in the given sort order (one of
+        `sort_orders`), optionally narrowed down to a collection of practice
+        codes
+
+        """
+        if sort not in self.by_sort_order:
+            raise ValueError("Unknown sort order {}".format(sort))
+        with timed("charts"):
+            charts = self.by_sort_order[sort].get(measure_id, [])
+            if practice_codes is None:
+                return list(charts)
+            practice_codes = set(practice_codes)
+            if len(practice_codes) >= len(charts):
+                return [x for x in charts if x.practice_code in practice_codes]
+            matched = []
+            for code in practice_codes:
+                chart = self.by_measure_and_practice.get((measure_id, code))
+                if chart:
+                    matched.append(chart)
+            return self._ordered(matched, sort)
+
+    def for_practices(self, practice_codes):
+        """Return charts for all measures for a collection of practice
+        codes, in sort key order
+
+        """
+        with timed("charts"):
+            practice_codes = set(practice_codes)
+            if len(practice_codes) == 1:
+                return list(self.by_practice.get(practice_codes.pop(), []))
+            matched = []
+            for code in practice_codes:
+                matched.extend(self.by_practice.get(code, []))
+            return sorted(matched, key=_sort_key)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _build_index(root):
+    global _index
+    previous = _index if _index is not None and _index.root == root else None
+    with timed("chart_index"):
+        index = ChartIndex(root, previous=previous)
+    _index = index
+    return index
+
+
+def get_chart_index():
+    """Return the chart index for `PREGENERATED_CHARTS_ROOT`, building it
+    on first use.
+
+    At most every `CHART_RELOAD_INTERVAL` seconds, checks whether the chart
+    directory has changed and if so replaces the index with a new one. Its
+    `signature` then changes too, so anything cached against the old index
+    expires. If the new index can't be built, the error is logged and the
+    current one kept; only building the first index raises.
+
+    """
+    root = settings.PREGENERATED_CHARTS_ROOT
+    index = _index
+    if index is None or index.root != root:
+        with _index_lock:
+            index = _index
+            if index is None or index.root != root:
+                index = _build_index(root)
+    elif time.monotonic() >= index.next_check and _index_lock.acquire(blocking=False):
+        # One thread checks for and loads new charts, while the others carry
+        # on with the current index
+        try:
+            if _index is index and directory_generation(root) != index.generation:
+                try:
+                    index = _build_index(root)
+                except Exception:
+                    # Carry on with the charts we have (a drop may be half
+                    # written), and try again after the interval
+                    logger.exception("Couldn't reload the chart index for %s", root)
+            index.next_check = time.monotonic() + getattr(
+                settings, "CHART_RELOAD_INTERVAL", 2
+            )
+        finally:
+            _index_lock.release()
+    return index
+
+
+def clear_chart_index():
+    """Forget the current index, so the next lookup rescans the chart
+    directory
+
+    """
+    global _index
+    with _index_lock:
+        _index = None
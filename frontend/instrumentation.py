@@ -0,0 +1,161 @@
+"""Per-request timing of SQL queries, chart lookups and template rendering.
+
+`ServerTimingMiddleware` records, for each request, how many SQL queries
+were run and how long they took, and how long was spent in sections of
+code wrapped in `timed()` (chart lookups and template rendering). It
+reports them in a `Server-Timing` header, which browsers show in their
+developer tools, and in a log line for each request. Requests slower than
+`SLOW_REQUEST_MS` are also logged at WARNING, with their slowest queries.
+
+It's only enabled when `SERVER_TIMING` is set; otherwise `timed()` does
+nothing.
+
+"""
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+from django.template.backends.django import Template
+from django.template.backends.django import reraise
+from django.template import TemplateDoesNotExist
+
+
+logger = logging.getLogger(__name__)
+
+# How many of a slow request's queries to log
+SLOW_QUERIES_LOGGED = 5
+
+_local = threading.local()
+
+
+class RequestTimings:
+    """Timings collected while handling one request
+    """
+
+    def __init__(self):
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.queries = []
+        self.seconds = {}
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        """Time a query, for use as a database execute wrapper
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.query_count += 1
+            self.query_seconds += duration
+            self.queries.append((duration, sql))
+
+    def slowest_queries(self, count):
+        return sorted(self.queries, key=lambda query: query[0], reverse=True)[:count]
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current request's timings
+    under `name`, if timings are being collected
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        with timed("template"):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with rendering timed under `template`
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 1)
+
+
+class ServerTimingMiddleware:
+    """Report SQL, chart lookup and template rendering times for each request
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "SERVER_TIMING", False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.slow_request_ms = getattr(settings, "SLOW_REQUEST_MS", 1000)
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        _local.timings = timings
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timings))
+                response = self.get_response(request)
+        finally:
+            _local.timings = None
+        total_ms = _milliseconds(time.perf_counter() - started)
+
+        metrics = [
+            'sql;dur={};desc="{} queries"'.format(
+                _milliseconds(timings.query_seconds), timings.query_count
+            )
+        ]
+        for name, seconds in sorted(timings.seconds.items()):
+            metrics.append("{};dur={}".format(name, _milliseconds(seconds)))
+        metrics.append("total;dur={}".format(total_ms))
+        response["Server-Timing"] = ", ".join(metrics)
+
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": total_ms,
+            "sql_queries": timings.query_count,
+            "sql_ms": _milliseconds(timings.query_seconds),
+        }
+        for name, seconds in sorted(timings.seconds.items()):
+            fields["{}_ms".format(name)] = _milliseconds(seconds)
+        message = " ".join("{}={}".format(key, value) for key, value in fields.items())
+        logger.info("request %s", message, extra={"timings": fields})
+        if total_ms > self.slow_request_ms:
+            logger.warning(
+                "slow request %s slowest_queries:\n%s",
+                message,
+                "\n".join(
+                    "{}ms {}".format(_milliseconds(duration), sql)
+                    for duration, sql in timings.slowest_queries(SLOW_QUERIES_LOGGED)
+                ),
+                extra={"timings": fields},
+            )
+        return response
@@ -0,0 +1,482 @@
+import asyncio
+import csv
+import json
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.db import connections
+from django.test import RequestFactory
+from django.test import override_settings
+
+from frontend import views
+from frontend.charts import clear_chart_index
+from frontend.charts import get_chart_index
+from frontend.charts import ChartIndex
+from frontend.models import Coding
+from frontend.models import Group
+from frontend.models import GroupKind
+from frontend.models import Measure
+from frontend.models import Practice
+from frontend.models import chart_urls
+from frontend.search import SearchIndex
+from frontend.search import get_search_index
+from openpath.asgi import ThreadPoolWsgiToAsgi
+
+
+# Differences in median time smaller than this are treated as noise
+NOISE_SECONDS = 0.001
+
+PRACTICES_CSV_FIELDS = [
+    "practice_ods_code",
+    "practice_name",
+    "ccg_ods_code",
+    "ccg_name",
+    "lab_code",
+    "lab_name",
+]
+
+
+def write_dataset(directory, practices, groups, measures):
+    """Write a synthetic dataset to `directory`: CSVs of practices and
+    measures in the format the importers expect, and an (empty) chart file
+    for every practice for every measure.
+
+    The groups are split between CCGs and labs, and practices are spread
+    evenly across them. Returns a dict of the paths written, and of codes
+    that are useful for filtering.
+
+    """
+    ccgs = max(1, groups // 2)
+    labs = max(1, groups - ccgs)
+    practices_path = os.path.join(directory, "practices.csv")
+    with open(practices_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=PRACTICES_CSV_FIELDS)
+        writer.writeheader()
+        for i in range(practices):
+            writer.writerow(
+                {
+                    "practice_ods_code": "P{:05d}".format(i),
+                    "practice_name": "BENCHMARK PRACTICE {}".format(i),
+                    "ccg_ods_code": "C{:03d}".format(i % ccgs),
+                    "ccg_name": "BENCHMARK CCG {}".format(i % ccgs),
+                    "lab_code": "L{:03d}".format(i % labs),
+                    "lab_name": "Benchmark lab {}".format(i % labs),
+                }
+            )
+
+    measures_path = os.path.join(directory, "measures.csv")
+    measure_ids = ["measure{:03d}".format(i) for i in range(measures)]
+    with open(measures_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["id", "title", "why_it_matters"])
+        writer.writeheader()
+        for measure_id in measure_ids:
+            writer.writerow(
+                {
+                    "id": measure_id,
+                    "title": "Benchmark measure {}".format(measure_id),
+                    "why_it_matters": "It is measured",
+                }
+            )
+
+    charts_root = os.path.join(directory, "charts")
+    os.makedirs(charts_root)
+    for measure_id in measure_ids:
+        for i in range(practices):
+            filename = "{}_P{:05d}_{}.png".format(measure_id, i, (i * 7919) % practices)
+            open(os.path.join(charts_root, filename), "w").close()
+
+    return {
+        "practices_csv": practices_path,
+        "measures_csv": measures_path,
+        "charts_root": charts_root,
+        "measure_id": measure_ids[0],
+        "practice_code": "ods/P00000",
+        "group_code": "ods/C000",
+        "practices": practices,
+        "measure_ids": measure_ids,
+    }
+
+
+class QueryCounter:
+    """A database execute wrapper which counts the queries run through it
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _delete_practices_and_groups():
+    Coding.objects.all().delete()
+    Practice.objects.all().delete()
+    Group.objects.all().delete()
+    GroupKind.objects.all().delete()
+
+
+def _clear_caches():
+    cache.clear()
+    Practice.objects.membership()
+    Group.objects.navigation()
+
+
+def _get(view, path, data=None, **kwargs):
+    def run():
+        response = view(RequestFactory().get(path, data or {}), **kwargs)
+        if response.status_code != 200:
+            raise CommandError("{} returned {}".format(path, response.status_code))
+
+    return run
+
+
+def scenarios(dataset):
+    """Return (name, setup, run) tuples for each benchmark. `setup` is called
+    before every run of `run`, and isn't timed.
+
+    """
+    measure_id = dataset["measure_id"]
+    practice_code = dataset["practice_code"]
+    group_code = dataset["group_code"]
+    group_practice_codes = Practice.objects.membership().practice_codes([group_code])
+    return [
+        (
+            "import_practices",
+            _delete_practices_and_groups,
+            lambda: call_command(
+                "import_practices", filename=dataset["practices_csv"], verbosity=0
+            ),
+        ),
+        (
+            "import_practices --bulk",
+            _delete_practices_and_groups,
+            lambda: call_command(
+                "import_practices",
+                "--bulk",
+                filename=dataset["practices_csv"],
+                stdout=StringIO(),
+            ),
+        ),
+        (
+            "import_measures",
+            lambda: Measure.objects.all().delete(),
+            lambda: call_command("import_measures", filename=dataset["measures_csv"]),
+        ),
+        (
+            "views.measure",
+            _clear_caches,
+            _get(views.measure, "/measure/{}".format(measure_id), measure=measure_id),
+        ),
+        (
+            "views.measure filtered",
+            _clear_caches,
+            _get(
+                views.measure,
+                "/measure/{}".format(measure_id),
+                {"filter": group_code},
+                measure=measure_id,
+            ),
+        ),
+        (
+            "views.practice",
+            _clear_caches,
+            _get(
+                views.practice,
+                "/practice/{}".format(practice_code),
+                practice=practice_code,
+            ),
+        ),
+        ("ChartIndex", lambda: None, lambda: ChartIndex(dataset["charts_root"])),
+        (
+            "chart_urls",
+            get_chart_index,
+            lambda: chart_urls(
+                ods_practice_codes=group_practice_codes, measure_id=measure_id
+            ),
+        ),
+        (
+            "filter_by_entity_code",
+            _clear_caches,
+            lambda: list(Practice.objects.filter_by_entity_code(group_code)),
+        ),
+        ("SearchIndex", _clear_caches, SearchIndex.build),
+        (
+            "search",
+            get_search_index,
+            lambda: get_search_index().search("benchmark pract", 10),
+        ),
+    ]
+
+
+def _request_in_thread(wsgi_application):
+    """Return a WSGI application that handles requests like
+    `wsgi_application`, but closes its thread's database connections after
+    each one, so they don't outlive the benchmark
+    """
+
+    def application(environ, start_response):
+        try:
+            return list(wsgi_application(environ, start_response))
+        finally:
+            connections.close_all()
+
+    return application
+
+
+def _scope(path):
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"host", b"localhost")],
+    }
+
+
+def entry_point_scenarios(dataset, concurrency):
+    """Return (name, setup, run) tuples for benchmarks that make `concurrency`
+    simultaneous requests for different pages through the full WSGI and
+    ASGI applications, including middleware
+    """
+    paths = ["/practice/ods/P{:05d}".format(i) for i in range(dataset["practices"])] + [
+        "/measure/{}".format(measure_id) for measure_id in dataset["measure_ids"]
+    ]
+    paths = (paths * concurrency)[:concurrency]
+    wsgi_application = _request_in_thread(get_wsgi_application())
+    asgi_application = ThreadPoolWsgiToAsgi(wsgi_application, threads=concurrency)
+
+    def start_response(status, headers, exc_info=None):
+        if not status.startswith("200"):
+            raise CommandError("Got {}".format(status))
+
+    def run_wsgi():
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(
+                executor.map(
+                    lambda path: wsgi_application(
+                        RequestFactory().get(path).environ, start_response
+                    ),
+                    paths,
+                )
+            )
+
+    async def request_asgi(path):
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start" and message["status"] != 200:
+                raise CommandError("{} returned {}".format(path, message["status"]))
+
+        await asgi_application(_scope(path), receive, send)
+
+    async def run_asgi():
+        await asyncio.gather(*(request_asgi(path) for path in paths))
+
+    name = "{} concurrent requests".format(concurrency)
+    return [
+        ("WSGI " + name, _clear_caches, run_wsgi),
+        ("ASGI " + name, _clear_caches, lambda: asyncio.run(run_asgi())),
+    ]
+
+
+def _time(setup, run, repeat):
+    """Time `run`, calling `setup` before each of `repeat` runs, returning a
+    dict of results including the queries made by the last run on this thread
+    """
+    timings = []
+    for _ in range(repeat):
+        setup()
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+        "queries": queries.count,
+    }
+
+
+def run_benchmarks(practices, groups, measures, repeat, concurrency=0):
+    """Build a synthetic dataset of the given size in the current database,
+    and time each scenario `repeat` times. If `concurrency` is given, also
+    compare serving that many requests at once through the WSGI and ASGI
+    entry points; this needs the data to be committed, so it can't be used
+    inside a test transaction.
+
+    Returns a dict of results, suitable for saving as JSON.
+
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = write_dataset(directory, practices, groups, measures)
+        with override_settings(
+            PREGENERATED_CHARTS_ROOT=dataset["charts_root"],
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+        ):
+            clear_chart_index()
+            call_command(
+                "import_practices",
+                "--bulk",
+                filename=dataset["practices_csv"],
+                stdout=StringIO(),
+            )
+            call_command("import_measures", filename=dataset["measures_csv"])
+            try:
+                for name, setup, run in scenarios(dataset):
+                    results[name] = _time(setup, run, repeat)
+                if concurrency:
+                    for name, setup, run in entry_point_scenarios(dataset, concurrency):
+                        result = _time(setup, run, repeat)
+                        # Requests are handled on other threads, whose
+                        # queries aren't counted
+                        result["queries"] = None
+                        results[name] = result
+            finally:
+                clear_chart_index()
+                cache.clear()
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "database": connection.vendor,
+        "params": {
+            "practices": practices,
+            "groups": groups,
+            "measures": measures,
+            "repeat": repeat,
+            "concurrency": concurrency,
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline, current, tolerance):
+    """Return a list of descriptions of each way `current` is worse than
+    `baseline`: any benchmark whose median time is more than `tolerance`
+    times the baseline's (and slower by more than NOISE_SECONDS), or which
+    makes more queries
+
+    """
+    if baseline["params"] != current["params"]:
+        raise CommandError(
+            "Baseline was run with {}, not {}".format(
+                baseline["params"], current["params"]
+            )
+        )
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        if (
+            result["median"] > before["median"] * tolerance
+            and result["median"] - before["median"] > NOISE_SECONDS
+        ):
+            regressions.append(
+                "{}: median {:.4f}s, was {:.4f}s".format(
+                    name, result["median"], before["median"]
+                )
+            )
+        if result["queries"] is not None and result["queries"] > before["queries"]:
+            regressions.append(
+                "{}: {} queries, was {}".format(
+                    name, result["queries"], before["queries"]
+                )
+            )
+    return regressions
+
+
+class Command(BaseCommand):
+    """Times views, chart lookups and importers against a synthetic dataset,
+    in a freshly created test database
+    """
+
+    args = ""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("--practices", type=int, default=1000)
+        parser.add_argument("--groups", type=int, default=50)
+        parser.add_argument("--measures", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=0,
+            help="Also compare serving this many requests at once over WSGI and ASGI",
+        )
+        parser.add_argument(
+            "--output", default="benchmark.json", help="Where to save the results"
+        )
+        parser.add_argument(
+            "--baseline", help="Results of an earlier run to compare against"
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=1.5,
+            help="How many times slower than the baseline a benchmark can be",
+        )
+        parser.add_argument(
+            "--keepdb", action="store_true", help="Reuse an existing test database"
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=options["keepdb"]
+        )
+        try:
+            current = run_benchmarks(
+                options["practices"],
+                options["groups"],
+                options["measures"],
+                options["repeat"],
+                options["concurrency"],
+            )
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options["keepdb"]
+            )
+
+        for name, result in current["results"].items():
+            self.stdout.write(
+                "{:<28} {:>9.4f}s median {:>9.4f}s min {:>6} queries".format(
+                    name,
+                    result["median"],
+                    result["min"],
+                    "-" if result["queries"] is None else result["queries"],
+                )
+            )
+        with open(options["output"], "w") as f:
+            json.dump(current, f, indent=2)
+        self.stdout.write("Saved results to {}".format(options["output"]))
+
+        if baseline:
+            regressions = compare_results(baseline, current, options["tolerance"])
+            if regressions:
+                raise CommandError(
+                    "Regressions against {}:\n{}".format(
+                        options["baseline"], "\n".join(regressions)
+                    )
+                )
+            self.stdout.write("No regressions against {}".format(options["baseline"]))
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from PIL import Image
+
+from frontend.charts import ATLAS_DIR
+from frontend.charts import ChartIndex
+from frontend.charts import DEFAULT_SORT
+
+
+def _source_signature(charts, stats, columns, tiles_per_atlas):
+    signature = hashlib.md5("{}:{}".format(columns, tiles_per_atlas).encode("utf-8"))
+    for chart in charts:
+        signature.update("{}:{}".format(chart.url, stats[chart.url]).encode("utf-8"))
+    return signature.hexdigest()
+
+
+def build_atlases(root, measure_id, charts, stats, columns, tiles_per_atlas):
+    """Pack `charts` (in rank order) into atlas images of at most
+    `tiles_per_atlas` tiles each, laid out `columns` tiles wide, and write
+    the manifest describing them
+
+    """
+    atlas_dir = os.path.join(root, ATLAS_DIR)
+    manifest_path = os.path.join(atlas_dir, "{}.json".format(measure_id))
+    previous_atlases = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous_atlases = json.load(f)["atlases"]
+
+    atlases = []
+    sha256s = []
+    atlas_stats = []
+    tiles = {}
+    for start in range(0, len(charts), tiles_per_atlas):
+        chunk = charts[start : start + tiles_per_atlas]
+        images = []
+        for chart in chunk:
+            with Image.open(os.path.join(root, chart.url)) as image:
+                images.append(image.convert("RGBA"))
+        tile_width = max(image.width for image in images)
+        tile_height = max(image.height for image in images)
+        rows = (len(images) + columns - 1) // columns
+        atlas = Image.new(
+            "RGBA", (tile_width * min(columns, len(images)), tile_height * rows)
+        )
+        for i, (chart, image) in enumerate(zip(chunk, images)):
+            x = (i % columns) * tile_width
+            y = (i // columns) * tile_height
+            atlas.paste(image, (x, y))
+            tiles[chart.url] = {
+                "atlas": len(atlases),
+                "x": x,
+                "y": y,
+                "width": image.width,
+                "height": image.height,
+                "stat": stats[chart.url],
+            }
+        tmp_path = os.path.join(atlas_dir, "{}.tmp.png".format(measure_id))
+        atlas.save(tmp_path, optimize=True)
+        with open(tmp_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        url = "{}/{}.{}.{}.png".format(ATLAS_DIR, measure_id, len(atlases), digest[:12])
+        os.replace(tmp_path, os.path.join(root, url))
+        stat = os.stat(os.path.join(root, url))
+        atlases.append(url)
+        sha256s.append(digest)
+        atlas_stats.append([stat.st_size, stat.st_mtime_ns])
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "source_signature": _source_signature(
+                    charts, stats, columns, tiles_per_atlas
+                ),
+                "atlases": atlases,
+                "sha256s": sha256s,
+                "stats": atlas_stats,
+                "tiles": tiles,
+            },
+            f,
+        )
+    os.replace(tmp_path, manifest_path)
+    for url in set(previous_atlases) - set(atlases):
+        path = os.path.join(root, url)
+        if os.path.exists(path):
+            os.remove(path)
+    return len(atlases)
+
+
+class Command(BaseCommand):
+    """Packs each measure's charts, in rank order, into a few atlas images so
+    a measure page can show many charts with a handful of requests.
+
+    Atlases are cut at page boundaries, so each page of a measure's charts
+    uses its own atlases, and no others. Tiles are shown at full size, and
+    aren't lazily loaded or served as WebP, unlike the charts' own images.
+    """
+
+    args = ""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("--columns", type=int, default=4)
+        parser.add_argument(
+            "--tiles-per-atlas",
+            type=int,
+            default=settings.CHARTS_PER_PAGE,
+            help="Must divide CHARTS_PER_PAGE (the default)",
+        )
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild atlases even if the measure's charts haven't changed",
+        )
+
+    def handle(self, *args, **options):
+        root = settings.PREGENERATED_CHARTS_ROOT
+        columns = options["columns"]
+        tiles_per_atlas = options["tiles_per_atlas"]
+        if tiles_per_atlas < 1 or settings.CHARTS_PER_PAGE % tiles_per_atlas:
+            raise CommandError(
+                "--tiles-per-atlas must divide CHARTS_PER_PAGE ({})".format(
+                    settings.CHARTS_PER_PAGE
+                )
+            )
+        os.makedirs(os.path.join(root, ATLAS_DIR), exist_ok=True)
+        index = ChartIndex(root)
+
+        started = time.time()
+        to_build = []
+        for measure_id, charts in sorted(index.by_sort_order[DEFAULT_SORT].items()):
+            previous = index.atlases.get(measure_id)
+            signature = _source_signature(charts, index.stats, columns, tiles_per_atlas)
+            if (
+                options["force"]
+                or not previous
+                or previous["source_signature"] != signature
+                or "stats" not in previous
+            ):
+                to_build.append((measure_id, charts))
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            futures = [
+                executor.submit(
+                    build_atlases,
+                    root,
+                    measure_id,
+                    charts,
+                    {chart.url: index.stats[chart.url] for chart in charts},
+                    columns,
+                    tiles_per_atlas,
+                )
+                for measure_id, charts in to_build
+            ]
+            atlas_count = sum(future.result() for future in futures)
+        self.stdout.write(
+            "Built {} atlases for {} measures ({} unchanged) in {:.2f}s".format(
+                atlas_count,
+                len(to_build),
+                len(index.by_measure) - len(to_build),
+                time.time() - started,
+            )
+        )
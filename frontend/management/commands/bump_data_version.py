@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from frontend.models import DataVersion
+
+
+class Command(BaseCommand):
+    """Bumps the data version, so that cached pages and lookups are rebuilt
+
+    Run this after changing data by any means other than the import commands.
+    """
+
+    args = ""
+    help = __doc__
+
+    def handle(self, *args, **options):
+        DataVersion.bump()
+        self.stdout.write("Data version is now {}".format(DataVersion.current()))
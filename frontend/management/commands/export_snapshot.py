@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from frontend.snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    """Exports practices, groups, codings and measures to a read-only SQLite
+    file, to serve pages from when SNAPSHOT_DATABASE points at it
+    """
+
+    args = ""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", default=getattr(settings, "SNAPSHOT_DATABASE", None)
+        )
+
+    def handle(self, *args, **options):
+        if not options["output"]:
+            raise CommandError("Please supply --output or set SNAPSHOT_DATABASE")
+        started = time.time()
+        counts = export_snapshot(options["output"])
+        for table, count in counts.items():
+            self.stdout.write("{}: {}".format(table, count))
+        self.stdout.write(
+            "Wrote {} in {:.2f}s".format(options["output"], time.time() - started)
+        )
@@ -1,8 +1,10 @@
+import hashlib
+import json
 import yaml
 import os
 import re
 import requests
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from datetime import datetime
 
@@ -23,22 +25,119 @@ VANILLA_TEMPLATE = """{{% extends "_base.html" %}}
 BLOG_LINK_TEMPLATE = '<li class="nav-item"><h3><a href="/blog/{url}">{title}</a></h3><small class="text-muted">{date}</small><p>{summary} <a href="{url}">[Read More...]</a></p></li>'
 
 
-def make_internal_link_replacements(pages):
+def make_internal_link_rewriter(pages):
     """Internal links in the source blogs may have different URLs from our
     imported links. For example, in a source blog we may link to
     `/myblog/a.html`, but that link target in our destination blog
-    should be `/a.html`. Build an array of regex replacements to
-    rewrite internal links so they work in the destination blog.
+    should be `/a.html`. Build a function that rewrites internal links
+    so they work in the destination blog, with a single pass of one
+    combined regex over the content.
 
     """
-    replacements = []
+    slugs_by_path = {}
     for page in pages:
         from_path = urlparse(page["url"]).path
         if from_path[-1] == "/":
             from_path = from_path[:-1]
-        from_regex = r"(href=.).*{}/?(\b)".format(from_path)
-        replacements.append((from_regex, r"\1/{}\2".format(page["slug"])))
-    return replacements
+        slugs_by_path[from_path] = page["slug"]
+    if not slugs_by_path:
+        return lambda content: content
+    # Longest paths first, so a path which is a prefix of another never
+    # wins the alternation
+    paths = sorted(slugs_by_path, key=len, reverse=True)
+    pattern = re.compile(
+        r"""(href=.)[^"']*?({})(?=/?\b)""".format("|".join(map(re.escape, paths)))
+    )
+
+    def replace(match):
+        return "{}/{}".format(match.group(1), slugs_by_path[match.group(2)])
+
+    return lambda content: pattern.sub(replace, content)
+
+
+def write_if_changed(path, content):
+    """Write `content` to `path` unless the file there already has the same
+    content hash.
+
+    Returns one of "added", "updated" or "skipped".
+
+    """
+    new = content.encode("utf-8")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(new).digest():
+                return "skipped"
+        outcome = "updated"
+    else:
+        outcome = "added"
+    with open(path, "wb") as f:
+        f.write(new)
+    return outcome
+
+
+def make_session(pool_size):
+    """Return a session whose connection pool is big enough to be shared by
+    `pool_size` worker threads
+
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _cache_paths(cache_dir, page):
+    base = os.path.join(cache_dir, page["slug"])
+    return base + ".html", base + ".json"
+
+
+def load_cached_page(cache_dir, page):
+    """Return the cached HTML for `page`, or None if it has never been fetched
+    """
+    html_path, _ = _cache_paths(cache_dir, page)
+    if not os.path.exists(html_path):
+        return None
+    with open(html_path, encoding="utf-8") as f:
+        return f.read()
+
+
+def fetch_page(session, cache_dir, page, timeout):
+    """Fetch the HTML for `page`, using a conditional request against the
+    cached copy if there is one.
+
+    Returns a tuple of the HTML and whether it came from the cache.
+
+    """
+    html_path, meta_path = _cache_paths(cache_dir, page)
+    cached_text = load_cached_page(cache_dir, page)
+    headers = {}
+    if cached_text is not None and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("url") == page["url"]:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+    response = session.get(page["url"], headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return cached_text, True
+    response.raise_for_status()
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(response.text)
+    with open(meta_path, "w") as f:
+        json.dump(
+            {
+                "url": page["url"],
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            },
+            f,
+        )
+    return response.text, False
 
 
 class Command(BaseCommand):
@@ -48,60 +147,113 @@ class Command(BaseCommand):
     args = ""
     help = __doc__
 
-    def handle(self, *args, **options):
+    def add_arguments(self, parser):
         this_dir = os.path.dirname(os.path.abspath(__file__))
-        template_dir = os.path.join(settings.BASE_DIR, "frontend", "templates")
+        parser.add_argument(
+            "--entries", default=os.path.join(this_dir, "blog_entries.yaml")
+        )
+        parser.add_argument(
+            "--template-dir",
+            default=os.path.join(settings.BASE_DIR, "frontend", "templates"),
+        )
+        parser.add_argument(
+            "--cache-dir", default=os.path.join(settings.BASE_DIR, ".blog_cache")
+        )
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument(
+            "--timeout", type=float, default=30, help="Per-request timeout in seconds"
+        )
+        parser.add_argument(
+            "--offline",
+            action="store_true",
+            help="Rebuild the templates from previously fetched pages",
+        )
+
+    def handle(self, *args, **options):
+        template_dir = options["template_dir"]
         blog_dir = os.path.join(template_dir, "blog")
+        cache_dir = options["cache_dir"]
         os.makedirs(blog_dir, exist_ok=True)
-        blog_entries_yaml_path = os.path.join(this_dir, "blog_entries.yaml")
+        os.makedirs(cache_dir, exist_ok=True)
         blog_index = []
-        with open(blog_entries_yaml_path) as f:
+        with open(options["entries"]) as f:
             pages = sorted(
                 yaml.load_all(f, Loader=yaml.FullLoader),
                 key=lambda x: x["date"],
                 reverse=True,
             )
-            link_replacements = make_internal_link_replacements(pages)
-            for page in pages:
-                response = requests.get(page["url"])
-                tree = html.fromstring(response.text)
-                date = page["date"].strftime("%d %b, %Y")
-                node = tree.xpath(page["xpath"])[0]
-                cleaner = Cleaner(safe_attrs_only=False, safe_attrs=[])
-                content = cleaner.clean_html(tostring(node, encoding="unicode"))
-                for from_regex, to in link_replacements:
-                    content = re.sub(from_regex, to, content)
-                content += "<hr><p><a href='{% url 'blog' %}'>Read more OpenPathology blogs</a></p>"
-                summary = filters.truncatewords(node.text_content(), 35)
-                content = (
-                    "<h1>{title}</h1><small class='text-muted'>{date}</small>".format(
-                        date=date, title=page["title"]
+        if options["offline"]:
+            texts = [load_cached_page(cache_dir, page) for page in pages]
+            missing = [page["url"] for page, text in zip(pages, texts) if text is None]
+            if missing:
+                raise CommandError(
+                    "No cached copy of {}; run without --offline first".format(
+                        ", ".join(missing)
                     )
-                    + content
                 )
-                blog_index.append(
-                    BLOG_LINK_TEMPLATE.format(
-                        url=page["slug"],
-                        title=page["title"],
-                        date=date,
-                        summary=summary,
+        else:
+            session = make_session(options["workers"])
+            with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                results = list(
+                    executor.map(
+                        lambda page: fetch_page(
+                            session, cache_dir, page, options["timeout"]
+                        ),
+                        pages,
                     )
                 )
-                with open(
-                    os.path.join(blog_dir, page["slug"] + ".html"), "w"
-                ) as blog_file:
-                    blog_file.write(VANILLA_TEMPLATE.format(content=content))
-            with open(os.path.join(template_dir, "blog.html"), "w") as blog_index_file:
-                content = (
-                    "<h1>Latest blogs</h1>"
-                    + "<ul class='nav'>"
-                    + "\n".join(blog_index)
-                    + "</ul>"
+            texts = [text for text, _ in results]
+            self.stdout.write(
+                "Fetched {} pages, {} unchanged since the last fetch".format(
+                    len(results), sum(1 for _, from_cache in results if from_cache)
+                )
+            )
+
+        rewrite_internal_links = make_internal_link_rewriter(pages)
+        outcomes = {"added": [], "updated": [], "skipped": []}
+        for page, text in zip(pages, texts):
+            tree = html.fromstring(text)
+            date = page["date"].strftime("%d %b, %Y")
+            node = tree.xpath(page["xpath"])[0]
+            cleaner = Cleaner(safe_attrs_only=False, safe_attrs=[])
+            content = cleaner.clean_html(tostring(node, encoding="unicode"))
+            content = rewrite_internal_links(content)
+            content += "<hr><p><a href='{% url 'blog' %}'>Read more OpenPathology blogs</a></p>"
+            summary = filters.truncatewords(node.text_content(), 35)
+            content = (
+                "<h1>{title}</h1><small class='text-muted'>{date}</small>".format(
+                    date=date, title=page["title"]
+                )
+                + content
+            )
+            blog_index.append(
+                BLOG_LINK_TEMPLATE.format(
+                    url=page["slug"], title=page["title"], date=date, summary=summary
+                )
+            )
+            outcome = write_if_changed(
+                os.path.join(blog_dir, page["slug"] + ".html"),
+                VANILLA_TEMPLATE.format(content=content),
+            )
+            outcomes[outcome].append("blog/{}.html".format(page["slug"]))
+        content = (
+            "<h1>Latest blogs</h1>"
+            + "<ul class='nav'>"
+            + "\n".join(blog_index)
+            + "</ul>"
+        )
+        outcome = write_if_changed(
+            os.path.join(template_dir, "blog.html"),
+            VANILLA_TEMPLATE.format(content=content),
+        )
+        outcomes[outcome].append("blog.html")
+        for outcome, names in outcomes.items():
+            self.stdout.write(
+                "{} {}: {}".format(
+                    len(names), outcome, ", ".join(names) if names else "-"
                 )
-                blog_index_file.write(VANILLA_TEMPLATE.format(content=content))
-        print(
-            subprocess.check_output(
-                ["git", "status", "-s", "--", "frontend/templates/blog"]
-            ).decode("ascii")
+            )
+        self.stdout.write(
+            "Finished. Now commit any added or updated templates listed above, "
+            "and deploy"
         )
-        print("Finished. Now commit any new content listed above, and deploy")
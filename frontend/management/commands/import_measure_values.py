@@ -0,0 +1,47 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from frontend.models import DataVersion
+from frontend.models import Measure
+from frontend.timeseries import write_measure_values
+
+
+def _number(value):
+    return float(value) if value != "" else float("nan")
+
+
+class Command(BaseCommand):
+    """Imports a CSV of monthly numerators and denominators for one measure,
+    with columns practice_ods_code, month, numerator and denominator
+    """
+
+    args = ""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("--filename", required=True)
+        parser.add_argument("--measure", required=True)
+
+    def handle(self, *args, **options):
+        if not Measure.objects.filter(pk=options["measure"]).exists():
+            raise CommandError("No measure with id {}".format(options["measure"]))
+
+        values = {}
+        with open(options["filename"], newline="") as f:
+            for row in csv.DictReader(f):
+                values[(row["practice_ods_code"], row["month"])] = (
+                    _number(row["numerator"]),
+                    _number(row["denominator"]),
+                )
+        # Pages are cached against the data version, so only bump it when
+        # the values have changed
+        if write_measure_values(
+            settings.MEASURE_VALUES_ROOT, options["measure"], values
+        ):
+            DataVersion.bump()
+            self.stdout.write(
+                "Imported {} values for {}".format(len(values), options["measure"])
+            )
+        else:
+            self.stdout.write("No changes to values for {}".format(options["measure"]))
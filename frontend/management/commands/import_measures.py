@@ -2,6 +2,7 @@ import csv
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
+from frontend.models import DataVersion
 from frontend.models import Measure
 
 
@@ -19,12 +20,16 @@ class Command(BaseCommand):
         if "filename" not in options:
             raise CommandError("Please supply a filename")
 
-        reader = csv.DictReader(open(options["filename"], "rU"))
+        reader = csv.DictReader(open(options["filename"], newline=""))
 
         sections = {}
         with transaction.atomic():
+            measures_before = list(Measure.objects.order_by("pk").values_list())
             for row in reader:
                 measure, _ = Measure.objects.get_or_create(id=row["id"])
                 measure.title = row["title"]
                 measure.why_it_matters = row["why_it_matters"]
                 measure.save()
+
+            if list(Measure.objects.order_by("pk").values_list()) != measures_before:
+                DataVersion.bump()
@@ -1,40 +1,190 @@
 import csv
+import time
+
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from django.db import transaction
 
 from frontend.models import Practice
 from frontend.models import Group
 from frontend.models import GroupKind
 from frontend.models import Coding
+from frontend.models import CodingRegistry
+from frontend.models import clear_coding_registry
+from frontend.models import DataVersion
+from frontend.models import EntityMembership
+
+
+BATCH_SIZE = 1000
+
 
+def _add_coding(registry, obj, system, code):
+    coding = Coding(content_object=obj, system=system, code=code)
+    coding.save()
+    registry.add(system, code, coding.content_type_id, obj.pk)
 
-def _get_or_create_group(system, code, name, kind):
-    try:
-        group = Group.objects.get(codes__system=system, codes__code=code)
+
+def _get_or_create_group(registry, system, code, name, kind):
+    group_id = registry.object_id(Group, system, code)
+    if group_id is not None:
+        group = Group.objects.get(pk=group_id)
         if group.name != name:
             group.name = name
             group.save()
         if group.kind != kind:
             group.kind = kind
             group.save()
-    except Group.DoesNotExist:
+    else:
         group = Group.objects.create(name=name, kind=kind)
-        Coding(content_object=group, system=system, code=code).save()
+        _add_coding(registry, group, system, code)
     return group
 
 
-def _get_or_create_practice(ods_code, name):
-    try:
-        practice = Practice.objects.get(codes__system="ods", codes__code=ods_code)
+def _get_or_create_practice(registry, ods_code, name):
+    practice_id = registry.object_id(Practice, "ods", ods_code)
+    if practice_id is not None:
+        practice = Practice.objects.get(pk=practice_id)
         if practice.name != name:
             practice.name = name
             practice.save()
-    except Practice.DoesNotExist:
+    else:
         practice = Practice.objects.create(name=name)
-        Coding(content_object=practice, system="ods", code=ods_code).save()
+        _add_coding(registry, practice, "ods", ods_code)
     return practice
 
 
+def _snapshot():
+    """Return everything about practices and groups that is shown on the
+    site, for detecting whether an import changed anything
+
+    """
+    return (
+        Group.objects.build_navigation(),
+        EntityMembership.build(),
+        list(Practice.objects.order_by("pk").values_list("pk", "name")),
+    )
+
+
+def _bulk_create(model, objs):
+    """Create `objs` in batches of at most BATCH_SIZE, or fewer if the
+    database can't take that many in one query (as with SQLite)
+    """
+    batch_size = min(
+        BATCH_SIZE,
+        max(connection.ops.bulk_batch_size(model._meta.concrete_fields, objs), 1),
+    )
+    return model.objects.bulk_create(objs, batch_size=batch_size)
+
+
+def _bulk_create_with_ids(model, objs):
+    """Create `objs`, making sure their primary keys are set afterwards
+    """
+    if connection.features.can_return_ids_from_bulk_insert:
+        return _bulk_create(model, objs)
+    for obj in objs:
+        obj.save()
+    return objs
+
+
+def _bulk_import(reader, registry, ccg_kind, lab_kind):
+    """Import practices and their group memberships from `reader`, diffing
+    them against the current state of the database and applying the
+    differences with bulk queries.
+
+    Returns a dict of counts of what was created and updated.
+
+    """
+    groups_wanted = {}
+    practices_wanted = {}
+    memberships_wanted = set()
+    for row in reader:
+        ccg_key = ("ods", row["ccg_ods_code"])
+        lab_key = ("lab", row["lab_code"])
+        groups_wanted[ccg_key] = (row["ccg_name"], ccg_kind)
+        groups_wanted[lab_key] = (row["lab_name"], lab_kind)
+        practices_wanted[row["practice_ods_code"]] = row["practice_name"]
+        memberships_wanted.add((row["practice_ods_code"], ccg_key))
+        memberships_wanted.add((row["practice_ods_code"], lab_key))
+
+    group_ids = {}
+    for group_id, codes in registry.objects(Group).items():
+        for key in codes:
+            group_ids[key] = group_id
+    practice_ids = {}
+    for practice_id, codes in registry.objects(Practice).items():
+        for system, code in codes:
+            if system == "ods":
+                practice_ids[code] = practice_id
+    groups = Group.objects.in_bulk(group_ids.values())
+    practices = Practice.objects.only("pk", "name").in_bulk(practice_ids.values())
+    counts = {}
+
+    new_groups = {}
+    changed_groups = []
+    for key, (name, kind) in groups_wanted.items():
+        group = groups.get(group_ids.get(key))
+        if group is None:
+            new_groups[key] = Group(name=name, kind=kind)
+        elif group.name != name or group.kind_id != kind.pk:
+            group.name = name
+            group.kind = kind
+            changed_groups.append(group)
+    _bulk_create_with_ids(Group, list(new_groups.values()))
+    _bulk_create(
+        Coding,
+        [
+            Coding(content_object=group, system=system, code=code)
+            for (system, code), group in new_groups.items()
+        ],
+    )
+    Group.objects.bulk_update(changed_groups, ["name", "kind"], batch_size=BATCH_SIZE)
+    for key, group in new_groups.items():
+        group_ids[key] = group.pk
+    counts["groups created"] = len(new_groups)
+    counts["groups updated"] = len(changed_groups)
+
+    new_practices = {}
+    changed_practices = []
+    for ods_code, name in practices_wanted.items():
+        practice = practices.get(practice_ids.get(ods_code))
+        if practice is None:
+            new_practices[ods_code] = Practice(name=name)
+        elif practice.name != name:
+            practice.name = name
+            changed_practices.append(practice)
+    _bulk_create_with_ids(Practice, list(new_practices.values()))
+    _bulk_create(
+        Coding,
+        [
+            Coding(content_object=practice, system="ods", code=ods_code)
+            for ods_code, practice in new_practices.items()
+        ],
+    )
+    Practice.objects.bulk_update(changed_practices, ["name"], batch_size=BATCH_SIZE)
+    for ods_code, practice in new_practices.items():
+        practice_ids[ods_code] = practice.pk
+    counts["practices created"] = len(new_practices)
+    counts["practices updated"] = len(changed_practices)
+
+    Membership = Practice.groups.through
+    existing_memberships = set(
+        Membership.objects.values_list("practice_id", "group_id")
+    )
+    new_memberships = {
+        (practice_ids[ods_code], group_ids[group_key])
+        for ods_code, group_key in memberships_wanted
+    } - existing_memberships
+    _bulk_create(
+        Membership,
+        [
+            Membership(practice_id=practice_id, group_id=group_id)
+            for practice_id, group_id in new_memberships
+        ],
+    )
+    counts["memberships created"] = len(new_memberships)
+    return counts
+
+
 class Command(BaseCommand):
     """Imports a CSV of practices with their lab/CCG membership
     """
@@ -44,30 +194,57 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--filename")
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            help="Diff the CSV against the database and apply changes in bulk",
+        )
 
     def handle(self, *args, **options):
         if "filename" not in options:
             raise CommandError("Please supply a filename")
 
-        reader = csv.DictReader(open(options["filename"], "rU"))
+        reader = csv.DictReader(open(options["filename"], newline=""))
 
-        sections = {}
+        started = time.time()
         with transaction.atomic():
+            snapshot_before = _snapshot()
             ccg_kind, _ = GroupKind.objects.get_or_create(name="ccg")
             lab_kind, _ = GroupKind.objects.get_or_create(name="lab")
+            # Built afresh rather than shared, as it's kept up to date with
+            # the codings created during the import
+            registry = CodingRegistry.build()
+
+            if options["bulk"]:
+                counts = _bulk_import(reader, registry, ccg_kind, lab_kind)
+            else:
+                counts = None
+                for row in reader:
+                    ccg = _get_or_create_group(
+                        registry, "ods", row["ccg_ods_code"], row["ccg_name"], ccg_kind
+                    )
+                    ccg.name = row["ccg_name"]
+                    ccg.save()
+                    lab = _get_or_create_group(
+                        registry, "lab", row["lab_code"], row["lab_name"], lab_kind
+                    )
+                    lab.name = row["lab_name"]
+                    practice = _get_or_create_practice(
+                        registry, row["practice_ods_code"], row["practice_name"]
+                    )
+                    practice.groups.add(ccg)
+                    practice.groups.add(lab)
+
+            # Bulk-created codings don't clear the shared registry
+            clear_coding_registry()
+            # Group navigation, membership and rendered pages are cached
+            # against the data version, so only bump it when the import has
+            # changed them
+            data_changed = _snapshot() != snapshot_before
+            if data_changed:
+                DataVersion.bump()
 
-            for row in reader:
-                ccg = _get_or_create_group(
-                    "ods", row["ccg_ods_code"], row["ccg_name"], ccg_kind
-                )
-                ccg.name = row["ccg_name"]
-                ccg.save()
-                lab = _get_or_create_group(
-                    "lab", row["lab_code"], row["lab_name"], lab_kind
-                )
-                lab.name = row["lab_name"]
-                practice = _get_or_create_practice(
-                    row["practice_ods_code"], row["practice_name"]
-                )
-                practice.groups.add(ccg)
-                practice.groups.add(lab)
+        if counts is not None:
+            for name, count in counts.items():
+                self.stdout.write("{}: {}".format(name, count))
+            self.stdout.write("Finished in {:.2f}s".format(time.time() - started))
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from frontend.charts import CHART_FILENAME_RE
+from frontend.charts import OPTIMISED_MANIFEST
+from frontend.charts import ChartIndex
+from frontend.charts import derivative_name
+
+
+DEFAULT_WIDTHS = "216,324"
+
+# Matches the filenames of charts and their derivatives (see
+# `derivative_name`); derivatives have a width or are WebP
+DERIVATIVE_RE = re.compile(
+    r"^(?P<stem>.+?)(?:\.(?P<width>\d+)w)?\.(?P<format>png|webp)$"
+)
+
+
+def _sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def derivative_names(url, entry):
+    """Return the filenames of the derivatives of the chart at `url`
+    described by its manifest `entry`
+    """
+    names = [derivative_name(url, None, "webp")]
+    for width in entry["widths"]:
+        names.append(derivative_name(url, width))
+        names.append(derivative_name(url, width, "webp"))
+    return names
+
+
+def _stat(path):
+    """Return the size and modification time of the file at `path`, as
+    recorded in the manifest, or None if there's no such file
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _is_current(root, url, entry, digest, widths):
+    """Return whether the manifest `entry` describes the chart at `url`, with
+    hash `digest`, and derivatives of `widths` that haven't changed since
+    """
+    if (
+        entry is None
+        or "derivative_stats" not in entry
+        or entry["sha256"] != digest
+        or entry["requested_widths"] != widths
+    ):
+        return False
+    stem_length = len(url) - len("png")
+    return all(
+        _stat(os.path.join(root, name))
+        == entry["derivative_stats"].get(name[stem_length:])
+        for name in derivative_names(url, entry)
+    )
+
+
+def remove_orphaned_derivatives(root, manifest, previous_urls):
+    """Delete derivatives in `root` that don't belong to a chart in
+    `manifest`: those of charts that have been removed or renamed, or of
+    widths no longer made. Returns the number deleted.
+
+    """
+    wanted = set()
+    for url, entry in manifest.items():
+        wanted.update(derivative_names(url, entry))
+    removed = 0
+    for name in os.listdir(root):
+        match = DERIVATIVE_RE.match(name)
+        if not match or not (match.group("width") or match.group("format") == "webp"):
+            continue
+        source = match.group("stem") + ".png"
+        if name in wanted:
+            continue
+        if (
+            source in manifest
+            or source in previous_urls
+            or CHART_FILENAME_RE.match(source)
+        ):
+            os.remove(os.path.join(root, name))
+            removed += 1
+    return removed
+
+
+def _save_if_smaller(image, path, **kwargs):
+    """Save `image` to `path` with the given options, keeping whichever of the
+    old and new files is smaller
+
+    """
+    tmp_path = path + ".tmp"
+    image.save(tmp_path, **kwargs)
+    if os.path.exists(path) and os.path.getsize(tmp_path) >= os.path.getsize(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+def optimise_chart(root, url, widths):
+    """Losslessly recompress the chart at `url` and write its derivatives.
+
+    Returns a tuple of the new manifest entry, and the number of bytes
+    saved.
+
+    """
+    path = os.path.join(root, url)
+    size_before = os.path.getsize(path)
+    with Image.open(path) as image:
+        image.load()
+    _save_if_smaller(image, path, format="PNG", optimize=True)
+    image.save(os.path.join(root, derivative_name(url, None, "webp")), lossless=True)
+    written_widths = []
+    for width in widths:
+        if width >= image.width:
+            continue
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), Image.LANCZOS)
+        resized.save(os.path.join(root, derivative_name(url, width)), optimize=True)
+        resized.save(
+            os.path.join(root, derivative_name(url, width, "webp")), lossless=True
+        )
+        written_widths.append(width)
+    entry = {
+        "sha256": _sha256(path),
+        "width": image.width,
+        "widths": written_widths,
+        "requested_widths": widths,
+    }
+    # Keyed by the part of each derivative's name after the chart's, so they
+    # still apply if the chart is renamed
+    stem_length = len(url) - len("png")
+    entry["derivatives"] = {
+        name[stem_length:]: _sha256(os.path.join(root, name))
+        for name in derivative_names(url, entry)
+    }
+    return entry, size_before - os.path.getsize(path)
+
+
+class Command(BaseCommand):
+    """Losslessly recompresses chart PNGs and writes resized and WebP versions
+    of each, for use in responsive `srcset`s
+    """
+
+    args = ""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--widths",
+            default=DEFAULT_WIDTHS,
+            help="Comma-separated widths of resized derivatives, in pixels",
+        )
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Reprocess charts even if they haven't changed",
+        )
+
+    def handle(self, *args, **options):
+        root = settings.PREGENERATED_CHARTS_ROOT
+        widths = sorted(int(width) for width in options["widths"].split(","))
+        manifest_path = os.path.join(root, OPTIMISED_MANIFEST)
+        manifest = {}
+        if os.path.exists(manifest_path) and not options["force"]:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        urls = [chart.url for chart in ChartIndex(root).charts]
+        # Previous entries by the hash of their (optimised) chart, so a chart
+        # that's only been renamed, as when its rank changes, can reuse its
+        # derivatives
+        previous_by_digest = {
+            entry["sha256"]: (url, entry) for url, entry in manifest.items()
+        }
+
+        started = time.time()
+        new_manifest = {}
+        to_optimise = []
+        renamed = 0
+        for url in urls:
+            digest = _sha256(os.path.join(root, url))
+            if _is_current(root, url, manifest.get(url), digest, widths):
+                new_manifest[url] = manifest[url]
+                continue
+            previous_url, entry = previous_by_digest.get(digest, (None, None))
+            if previous_url and _is_current(root, previous_url, entry, digest, widths):
+                for previous_name, name in zip(
+                    derivative_names(previous_url, entry), derivative_names(url, entry),
+                ):
+                    shutil.copyfile(
+                        os.path.join(root, previous_name), os.path.join(root, name)
+                    )
+                new_manifest[url] = entry
+                renamed += 1
+                continue
+            to_optimise.append(url)
+
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            results = list(
+                executor.map(
+                    optimise_chart,
+                    [root] * len(to_optimise),
+                    to_optimise,
+                    [widths] * len(to_optimise),
+                    chunksize=16,
+                )
+            )
+        bytes_saved = 0
+        for url, (entry, saved) in zip(to_optimise, results):
+            new_manifest[url] = entry
+            bytes_saved += saved
+        # Recorded so the chart index can tell whether a chart or derivative
+        # has changed since it was hashed, without hashing it again
+        for url, entry in new_manifest.items():
+            stem_length = len(url) - len("png")
+            new_manifest[url] = dict(
+                entry,
+                stat=_stat(os.path.join(root, url)),
+                derivative_stats={
+                    name[stem_length:]: _stat(os.path.join(root, name))
+                    for name in derivative_names(url, entry)
+                },
+            )
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(new_manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+        removed = remove_orphaned_derivatives(root, new_manifest, set(manifest))
+        self.stdout.write(
+            "Optimised {} charts ({} unchanged, {} renamed), saving {:.1f} KB, "
+            "and removed {} orphaned derivatives in {:.2f}s".format(
+                len(to_optimise),
+                len(urls) - len(to_optimise) - renamed,
+                renamed,
+                bytes_saved / 1024,
+                removed,
+                time.time() - started,
+            )
+        )
@@ -0,0 +1,144 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.urls import resolve
+from django.urls import reverse
+
+from frontend.models import DataVersion
+from frontend.models import Group
+from frontend.models import Measure
+from frontend.models import Practice
+from frontend.prerender import page_stamp
+from frontend.prerender import prerendered_file_path
+
+
+def pages_to_render(measure_ids=None, group_codes=None):
+    """Return (path, filter) tuples for the pages to render.
+
+    With no arguments, that's every page. `measure_ids` narrows them down
+    to the pages that show those measures (including practice pages with a
+    chart for them). `group_codes` narrows them down to the pages that show
+    those groups: every measure page (whose navigation lists the groups),
+    its variants filtered by those groups, and the pages of practices in
+    them.
+
+    """
+    measures = Measure.objects.order_by("pk")
+    if measure_ids:
+        measures = measures.filter(pk__in=measure_ids)
+    navigation_codes = [group["code"] for group in Group.objects.navigation()]
+    pages = []
+    if not group_codes:
+        pages.append((reverse("measures"), None))
+    for measure_id in measures.values_list("pk", flat=True):
+        path = reverse("measure", kwargs={"measure": measure_id})
+        pages.append((path, None))
+        for code in navigation_codes:
+            if not group_codes or code in group_codes:
+                pages.append((path, code))
+    membership = Practice.objects.membership()
+    if group_codes:
+        practice_codes = set()
+        for code in group_codes:
+            practice_codes |= membership.practice_codes([code])
+    else:
+        practice_codes = membership.practice_codes()
+    if measure_ids:
+        practice_codes = {
+            chart.practice_code
+            for measure in measures
+            for chart in measure.charts(ods_practice_codes=practice_codes)
+        }
+    for code in sorted(practice_codes):
+        pages.append((reverse("practice", kwargs={"practice": "ods/" + code}), None))
+    return pages
+
+
+def render_page(path, code_filter):
+    """Render the page at `path` with the given filter, returning its HTML
+    """
+    data = {"filter": code_filter} if code_filter else {}
+    request = RequestFactory().get(path, data)
+    match = resolve(path)
+    response = match.func(request, *match.args, **match.kwargs)
+    if response.status_code != 200:
+        raise CommandError(
+            "{}?filter={} returned {}".format(path, code_filter, response.status_code)
+        )
+    return response.content
+
+
+class Command(BaseCommand):
+    """Renders measure and practice pages to static HTML files, to be served by
+    PrerenderedPagesMiddleware without touching the database
+    """
+
+    args = ""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output-dir", default=getattr(settings, "PRERENDERED_PAGES_ROOT", None)
+        )
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument(
+            "--measure",
+            action="append",
+            help="Only render pages showing this measure (may be repeated)",
+        )
+        parser.add_argument(
+            "--group",
+            action="append",
+            help="Only render pages filtered by this group code, e.g. ods/11N "
+            "(may be repeated)",
+        )
+
+    def handle(self, *args, **options):
+        output_dir = options["output_dir"]
+        if not output_dir:
+            raise CommandError(
+                "Please supply --output-dir or set PRERENDERED_PAGES_ROOT"
+            )
+        pages = pages_to_render(options["measure"], options["group"])
+        # Taken before rendering, so pages rendered while the data or charts
+        # change are treated as out of date
+        data_version = DataVersion.current()
+        stamp = page_stamp(data_version)
+        DataVersion.write_file(output_dir)
+
+        def render_pages(chunk):
+            try:
+                for path, code_filter in chunk:
+                    content = render_page(path, code_filter)
+                    file_path = prerendered_file_path(output_dir, path, code_filter)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    # Write then rename, so a page being served is never
+                    # half-written
+                    tmp_path = file_path + ".tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(stamp)
+                        f.write(content)
+                    os.replace(tmp_path, file_path)
+            finally:
+                if workers > 1:
+                    connection.close()
+
+        workers = max(1, min(options["workers"], len(pages)))
+        started = time.time()
+        if workers == 1:
+            render_pages(pages)
+        else:
+            chunks = [pages[i::workers] for i in range(workers)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(render_pages, chunks))
+        elapsed = time.time() - started
+        self.stdout.write(
+            "Rendered {} pages in {:.2f}s ({:.1f} pages/s)".format(
+                len(pages), elapsed, len(pages) / elapsed if elapsed else 0
+            )
+        )
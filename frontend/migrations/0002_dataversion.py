@@ -0,0 +1,34 @@
+# Generated by Django 2.2.24 on 2026-10-17 18:33
+
+from django.db import migrations, models
+
+
+def create_data_version(apps, schema_editor):
+    DataVersion = apps.get_model("frontend", "DataVersion")
+    DataVersion.objects.create(version=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("frontend", "0001_initial_squashed_0003_auto_20190722_1630"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DataVersion",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_data_version, migrations.RunPython.noop),
+    ]
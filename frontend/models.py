@@ -1,25 +1,209 @@
-import glob
 import os
+import threading
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count
+from django.db.models import F
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 
 from common.utils import nhs_titlecase
+from frontend.charts import DEFAULT_SORT
+from frontend.charts import get_chart_index
+from frontend.timeseries import get_measure_values
+
+
+class DataVersion(models.Model):
+    """A single row whose version is bumped whenever imported data changes.
+
+    Anything derived from the data can be cached against the current
+    version, and is rebuilt the first time it is needed after a bump.
+
+    """
+
+    version = models.PositiveIntegerField(default=0)
+
+    # Written next to pre-rendered pages, so they can be checked against the
+    # version without querying the database (see `frontend.prerender`)
+    FILENAME = ".data_version"
+
+    @classmethod
+    def current(cls):
+        return cls.objects.values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.update(version=F("version") + 1):
+            cls.objects.create(version=1)
+        # Written straight away, rather than once committed: until then it's
+        # ahead of the database, so pre-rendered pages are only ever treated
+        # as out of date too soon
+        cls.write_file()
+
+    @classmethod
+    def write_file(cls, root=None):
+        """Record the current version in `root` (by default
+        `PRERENDERED_PAGES_ROOT`, if it's set)
+        """
+        root = root or getattr(settings, "PRERENDERED_PAGES_ROOT", None)
+        if not root:
+            return
+        os.makedirs(root, exist_ok=True)
+        path = os.path.join(root, cls.FILENAME)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(cls.current()))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def read_file(cls, root):
+        """Return the version recorded in `root`, or None if there isn't one
+        """
+        try:
+            with open(os.path.join(root, cls.FILENAME)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+def cached_for_data_version(name, build):
+    """Return the value cached under `name` for the current data version,
+    calling `build` to generate it if it isn't cached yet
+
+    """
+    key = "{}:{}".format(name, DataVersion.current())
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, timeout=None)
+    return value
+
+
+class InProcessCache:
+    """A value built at most once per process per data version, and held in
+    memory, for values used on most requests that would be slow to unpickle
+    from the cache every time
+
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = DataVersion.current()
+        value = self._value
+        if value is None or value[0] != version:
+            with self._lock:
+                value = self._value
+                if value is None or value[0] != version:
+                    value = (version, self.build())
+                    self._value = value
+        return value[1]
+
+    def clear(self, **kwargs):
+        """Forget the value, so it's rebuilt on next use; takes `**kwargs` so
+        that it can be connected to signals
+        """
+        with self._lock:
+            self._value = None
+
+
+class CodingRegistry:
+    """An in-memory map between entity codes and the objects they identify,
+    in both directions.
+
+    Codes are (system, code) tuples, and objects are (content type id,
+    object id) tuples, as stored in Coding.
+
+    """
+
+    def __init__(self):
+        self.objects_by_code = {}
+        self.codes_by_object = {}
+
+    @classmethod
+    def build(cls):
+        registry = cls()
+        codings = Coding.objects.order_by("pk").values_list(
+            "system", "code", "content_type_id", "object_id"
+        )
+        for system, code, content_type_id, object_id in codings:
+            registry.add(system, code, content_type_id, object_id)
+        return registry
+
+    def add(self, system, code, content_type_id, object_id):
+        self.objects_by_code[(system, code)] = (content_type_id, object_id)
+        self.codes_by_object.setdefault((content_type_id, object_id), []).append(
+            (system, code)
+        )
+
+    def object_id(self, model, system, code):
+        """Return the primary key of the `model` instance with the given code,
+        or None if no instance of `model` has it
+
+        """
+        content_type_id, object_id = self.objects_by_code.get(
+            (system, code), (None, None)
+        )
+        if content_type_id != ContentType.objects.get_for_model(model).pk:
+            return None
+        return object_id
+
+    def codes(self, model, object_id):
+        """Return the (system, code) tuples of the `model` instance with
+        primary key `object_id`
+
+        """
+        content_type_id = ContentType.objects.get_for_model(model).pk
+        return self.codes_by_object.get((content_type_id, object_id), [])
+
+    def objects(self, model):
+        """Return a dict mapping the primary key of each `model` instance
+        with codes to its (system, code) tuples
+
+        """
+        content_type_id = ContentType.objects.get_for_model(model).pk
+        return {
+            object_id: codes
+            for (type_id, object_id), codes in self.codes_by_object.items()
+            if type_id == content_type_id
+        }
+
+
+_registry = InProcessCache(lambda: CodingRegistry.build())
+
+
+def clear_coding_registry(**kwargs):
+    """Forget the current registry, so the next lookup reloads it
+    """
+    _registry.clear()
 
 
 class Coding(models.Model):
     """All entities in the system have a code which is unique as a (system, code) tuple
     """
 
+    class Manager(models.Manager):
+        def registry(self):
+            """Return the CodingRegistry for the current data version, loading
+            it once per process per version
+
+            """
+            return _registry.get()
+
     system = models.CharField(max_length=200, db_index=True)
     code = models.CharField(max_length=50, db_index=True)
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey("content_type", "object_id")
+    objects = Manager()
 
     class Meta:
         constraints = [
@@ -32,16 +216,52 @@ class Coding(models.Model):
         return "{}/{}".format(self.system, self.code)
 
 
+# Codings changed in this process take effect straight away; other processes
+# pick them up when the data version is bumped
+post_save.connect(clear_coding_registry, sender=Coding)
+post_delete.connect(clear_coding_registry, sender=Coding)
+
+
 class GroupKind(models.Model):
     name = models.CharField(max_length=200)
 
 
 class Group(models.Model):
+    class Manager(models.Manager):
+        def navigation(self):
+            """Return the groups that have practices, for navigating measure
+            pages, cached for the current data version
+
+            """
+            return cached_for_data_version("group_navigation", self.build_navigation)
+
+        def build_navigation(self):
+            group_codes = {
+                object_id: "{}/{}".format(*codes[0])
+                for object_id, codes in Coding.objects.registry().objects(Group).items()
+            }
+            groups = (
+                self.annotate(practice_count=Count("practice"))
+                .filter(practice_count__gt=0)
+                .order_by("pk")
+                .values_list("pk", "name", "kind__name", "practice_count")
+            )
+            return [
+                {
+                    "code": group_codes.get(pk),
+                    "name": name,
+                    "kind": kind,
+                    "practice_count": practice_count,
+                }
+                for pk, name, kind, practice_count in groups
+            ]
+
     name = models.CharField(max_length=200)
     kind = models.ForeignKey(GroupKind, on_delete=models.PROTECT)
     codes = GenericRelation(Coding, related_query_name="group")
     open_date = models.DateField(null=True, blank=True)
     close_date = models.DateField(null=True, blank=True)
+    objects = Manager()
 
 
 class Practice(models.Model):
@@ -50,15 +270,21 @@ class Practice(models.Model):
     """
 
     class Manager(models.Manager):
+        def membership(self):
+            """Return the EntityMembership for the current data version,
+            building it once per process per version
+            """
+            return _membership.get()
+
         def filter_by_entity_code(self, code_filter):
-            code_system, code = code_filter.split("/")
-            return Practice.objects.filter(
-                (Q(codes__system=code_system) & Q(codes__code=code))
-                | (Q(groups__codes__system=code_system) & Q(groups__codes__code=code))
-            ).distinct()
+            return self.filter(pk__in=self.membership().practice_ids([code_filter]))
 
         def get_by_entity_code(self, code_filter):
-            return self.filter_by_entity_code(code_filter).get()
+            system, _, code = code_filter.partition("/")
+            practice_id = Coding.objects.registry().object_id(Practice, system, code)
+            if practice_id is None:
+                return self.filter_by_entity_code(code_filter).get()
+            return self.get(pk=practice_id)
 
     PRESCRIBING_SETTINGS = (
         (-1, "Unknown"),
@@ -135,44 +361,136 @@ class Practice(models.Model):
         else:
             return ""
 
+    def _address_parts(self):
+        return [
+            part
+            for part in (
+                self.address2,
+                self.address3,
+                self.address4,
+                self.address5,
+                self.postcode,
+            )
+            if part
+        ]
+
     def address_pretty(self):
-        address = self.address1 + ", "
-        if self.address2:
-            address += self.address2 + ", "
-        if self.address3:
-            address += self.address3 + ", "
-        if self.address4:
-            address += self.address4 + ", "
-        if self.address5:
-            address += self.address5 + ", "
-        address += self.postcode
-        return address
+        return ", ".join(
+            part for part in [self.address1] + self._address_parts() if part
+        )
 
     def address_pretty_minus_firstline(self):
-        address = ""
-        if self.address2:
-            address += self.address2 + ", "
-        if self.address3:
-            address += self.address3 + ", "
-        if self.address4:
-            address += self.address4 + ", "
-        if self.address5:
-            address += self.address5 + ", "
-        address += self.postcode
-        return address
+        return ", ".join(self._address_parts())
 
     def ods_code(self):
-        return Coding.objects.get(system="ods", object_id=self.pk)
+        """Return this practice's ODS code, or None if it doesn't have one
+        """
+        for system, code in Coding.objects.registry().codes(Practice, self.pk):
+            if system == "ods":
+                return code
+        return None
 
 
-def _sorted_files_at_glob(file_name_glob):
-    # The final part of the filename, when split by underscore, is
-    # a sort key generated when the chart is created
-    files = sorted(
-        glob.glob(file_name_glob),
-        key=lambda filename: int(filename.split("_")[-1].split(".")[0]),
-    )
-    return [os.path.relpath(x, start=settings.PREGENERATED_CHARTS_ROOT) for x in files]
+class EntityMembership:
+    """A precomputed mapping from entity codes to the practices they cover.
+
+    A practice's own codes (e.g. `ods/L82001`) map to that practice, and a
+    group's codes (e.g. `ods/11N`, `lab/REF`) map to every practice in the
+    group. Practices are identified by their ODS code.
+
+    """
+
+    def __init__(self, practice_ids_by_ods_code, ods_codes_by_entity_code):
+        self.practice_ids_by_ods_code = practice_ids_by_ods_code
+        self.ods_codes_by_entity_code = ods_codes_by_entity_code
+
+    @classmethod
+    def build(cls):
+        registry = Coding.objects.registry()
+        practice_codes = registry.objects(Practice)
+        group_codes = registry.objects(Group)
+
+        practice_ids_by_ods_code = {}
+        ods_code_by_practice_id = {}
+        for practice_id, codes in practice_codes.items():
+            for system, code in codes:
+                if system == "ods":
+                    practice_ids_by_ods_code[code] = practice_id
+                    ods_code_by_practice_id[practice_id] = code
+
+        members = {}
+        for practice_id, codes in practice_codes.items():
+            ods_code = ods_code_by_practice_id.get(practice_id)
+            if ods_code:
+                for system, code in codes:
+                    members.setdefault("{}/{}".format(system, code), set()).add(
+                        ods_code
+                    )
+        for group_id, codes in group_codes.items():
+            for system, code in codes:
+                members.setdefault("{}/{}".format(system, code), set())
+        memberships = Practice.groups.through.objects.values_list(
+            "practice_id", "group_id"
+        )
+        for practice_id, group_id in memberships:
+            ods_code = ods_code_by_practice_id.get(practice_id)
+            if ods_code:
+                for system, code in group_codes.get(group_id, []):
+                    members["{}/{}".format(system, code)].add(ods_code)
+
+        return cls(
+            practice_ids_by_ods_code,
+            {code: frozenset(ods_codes) for code, ods_codes in members.items()},
+        )
+
+    def __eq__(self, other):
+        return (
+            self.practice_ids_by_ods_code == other.practice_ids_by_ods_code
+            and self.ods_codes_by_entity_code == other.ods_codes_by_entity_code
+        )
+
+    def practice_codes(self, code_filters=None):
+        """Return the ODS codes of practices matching every one of
+        `code_filters`, or of all practices if there are no filters
+
+        """
+        if not code_filters:
+            return frozenset(self.practice_ids_by_ods_code)
+        matches = sorted(
+            (
+                self.ods_codes_by_entity_code.get(code_filter, frozenset())
+                for code_filter in code_filters
+            ),
+            key=len,
+        )
+        return frozenset.intersection(*matches)
+
+    def practice_ids(self, code_filters=None):
+        """Return the primary keys of practices matching every one of
+        `code_filters`
+
+        """
+        return [
+            self.practice_ids_by_ods_code[ods_code]
+            for ods_code in self.practice_codes(code_filters)
+        ]
+
+
+_membership = InProcessCache(lambda: EntityMembership.build())
+
+
+def clear_entity_membership(**kwargs):
+    """Forget the current membership mapping, so the next lookup rebuilds it
+    """
+    _membership.clear()
+
+
+# As with codings, membership changed in this process takes effect straight
+# away
+for sender in (Coding, Practice, Group):
+    post_save.connect(clear_entity_membership, sender=sender)
+    post_delete.connect(clear_entity_membership, sender=sender)
+m2m_changed.connect(clear_entity_membership, sender=Practice.groups.through)
 
 
 def chart_urls(ods_practice_codes=None, measure_id=None):
@@ -181,22 +499,12 @@ def chart_urls(ods_practice_codes=None, measure_id=None):
     Narrows down to a specific measure and/or a list of practice codes.
 
     """
+    index = get_chart_index()
     if measure_id:
-        file_name_glob = "{}_*_*.png".format(measure_id)
-    elif len(ods_practice_codes) == 1:
-        file_name_glob = "*_{}_*.png".format(ods_practice_codes[0])
-
-    file_name_glob = os.path.join(settings.PREGENERATED_CHARTS_ROOT, file_name_glob)
-    urls = _sorted_files_at_glob(file_name_glob)
-    if ods_practice_codes is not None:
-        matched = []
-        for url in urls:
-            for must_match in ods_practice_codes:
-                if "_{}_".format(must_match) in url:
-                    matched.append(url)
-                    continue
-        urls = matched
-    return urls
+        charts = index.for_measure(measure_id, practice_codes=ods_practice_codes)
+    else:
+        charts = index.for_practices(ods_practice_codes)
+    return [chart.url for chart in charts]
 
 
 class Measure(models.Model):
@@ -204,6 +512,20 @@ class Measure(models.Model):
     title = models.CharField(max_length=500)
     why_it_matters = models.TextField(null=True, blank=True)
 
+    def charts(self, ods_practice_codes=None, sort=DEFAULT_SORT):
+        """Return pregenerated charts for this measure, in the given sort
+        order
+
+        """
+        return get_chart_index().for_measure(
+            self.id, practice_codes=ods_practice_codes, sort=sort
+        )
+
+    def values(self):
+        """Return the MeasureValues imported for this measure, or None
+        """
+        return get_measure_values(self.id)
+
     def chart_urls(self, ods_practice_codes=None):
         """Return list of URLs for pregenerated charts, for this measure
 
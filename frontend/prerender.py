@@ -0,0 +1,105 @@
+"""Serving of pages pre-rendered by the `prerender_pages` command.
+
+Measure and practice pages only change when data is imported, so they can
+be rendered to HTML files ahead of time. Each page, including the
+`?filter=` variants of measure pages, maps to one file under
+`PRERENDERED_PAGES_ROOT`.
+
+Each file starts with a line recording the data version and chart index
+signature it was rendered for (see `page_stamp`). A file whose stamp doesn't
+match the current ones is out of date, and the request falls through to the
+view instead. The current data version is read from a file that
+`DataVersion.bump` and `prerender_pages` write next to the pages, rather
+than from the database, and the chart signature from the in-memory chart
+index.
+
+"""
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.utils.cache import patch_response_headers
+
+from frontend.charts import get_chart_index
+from frontend.models import DataVersion
+
+
+PRERENDERED_PREFIXES = ("/measures/", "/measure/", "/practice/")
+
+
+def page_stamp(data_version):
+    """Return the first line of a page pre-rendered from the given data
+    version and the current charts
+    """
+    return "<!-- prerendered data_version={} charts={} -->\n".format(
+        data_version, get_chart_index().signature
+    ).encode("ascii")
+
+
+def prerendered_file_path(root, path, code_filter=None):
+    """Return the file that holds the pre-rendered page at `path`, or None if
+    the path can't be pre-rendered
+
+    """
+    if not path.startswith(PRERENDERED_PREFIXES):
+        return None
+    parts = [part for part in path.split("/") if part]
+    if any(part in (".", "..") for part in parts):
+        return None
+    if code_filter:
+        filename = "filter={}.html".format(quote(code_filter, safe=""))
+    else:
+        filename = "index.html"
+    return os.path.join(root, *parts, filename)
+
+
+class PrerenderedPagesMiddleware:
+    """Serve pre-rendered pages straight from disk, without touching views or
+    the database.
+
+    Only plain GET/HEAD requests (optionally with a single `filter`) are
+    served; anything else, or any page that hasn't been rendered for the
+    current data and charts, falls through to the view. It comes before the
+    session, CSRF and authentication middleware, none of which pre-rendered
+    pages need, and adds the caching and `X-Frame-Options` headers that later
+    middleware would.
+
+    """
+
+    def __init__(self, get_response):
+        self.root = getattr(settings, "PRERENDERED_PAGES_ROOT", None)
+        if not self.root:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.x_frame_options = XFrameOptionsMiddleware()
+
+    def __call__(self, request):
+        if request.method in ("GET", "HEAD"):
+            path = self._file_for_request(request)
+            data_version = DataVersion.read_file(self.root)
+            if path and data_version is not None and os.path.isfile(path):
+                f = open(path, "rb")
+                stamp = f.readline()
+                if stamp == page_stamp(data_version):
+                    response = FileResponse(f, content_type="text/html; charset=utf-8")
+                    response["Content-Length"] = os.path.getsize(path) - len(stamp)
+                    response["X-Prerendered"] = "1"
+                    # As UpdateCacheMiddleware does for rendered pages
+                    patch_response_headers(
+                        response, cache_timeout=settings.CACHE_MIDDLEWARE_SECONDS
+                    )
+                    return self.x_frame_options.process_response(request, response)
+                f.close()
+        return self.get_response(request)
+
+    def _file_for_request(self, request):
+        params = set(request.GET)
+        if params - {"filter"} or len(request.GET.getlist("filter")) > 1:
+            return None
+        code_filter = request.GET.get("filter")
+        if code_filter == "":
+            return None
+        return prerendered_file_path(self.root, request.path_info, code_filter)
@@ -0,0 +1,200 @@
+"""An in-memory prefix index for finding practices and groups as the user
+types.
+
+Practices are indexed by the words in their names (as imported, and as
+titlecased for display) and by their ODS codes; groups by the words in their
+names and by their codes. Words are kept in one sorted list, so the words
+starting with a given prefix are found by bisecting it, rather than by
+scanning the tables, and the entries for short prefixes are worked out in
+advance. A query matches the entries that have, for each word in the
+query, a word starting with it.
+
+The index is built from the database once per process per data version
+(see `get_search_index`).
+
+"""
+import bisect
+import heapq
+import re
+from collections import namedtuple
+
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from common.utils import nhs_titlecase
+from frontend.models import Coding
+from frontend.models import Group
+from frontend.models import InProcessCache
+from frontend.models import Practice
+
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+# An entity code, such as ods/A81001, searched for by the part after the "/"
+ENTITY_CODE_RE = re.compile(r"^\s*[a-z]+/(?P<code>\S+)\s*$", re.IGNORECASE)
+
+# Prefixes up to this long have their matching results precomputed, since
+# they match the most results
+SHORT_PREFIX_LENGTH = 3
+
+SearchResult = namedtuple("SearchResult", ["name", "kind", "code"])
+
+
+def words(text):
+    """Return the lowercased words in `text`
+    """
+    return WORD_RE.findall(text.lower())
+
+
+class SearchIndex:
+    """Practices and groups, indexed by the prefixes of their words.
+
+    Built from a list of (SearchResult, names, codes) tuples: each result
+    is found by the words in its `names` or by any of its `codes`, and is
+    shown as the first of its `names`. Results are numbered in name order,
+    so that walking the matches for a prefix in number order finds them in
+    name order, and can stop as soon as there are enough.
+
+    """
+
+    def __init__(self, entries):
+        entries = sorted(entries, key=lambda entry: " ".join(words(entry[1][0])))
+        self.results = []
+        self._words = []
+        self._ids_by_code = {}
+        self._names = []
+        # Ids are assigned in order, so each of these lists is sorted
+        self._ids_by_word = {}
+        ids_by_short_prefix = {}
+        for result_id, (result, names, codes) in enumerate(entries):
+            result_words = set()
+            for code in codes:
+                code = code.lower()
+                result_words.add(code)
+                self._ids_by_code.setdefault(code, []).append(result_id)
+            for name in names:
+                result_words.update(words(name))
+            self.results.append(result)
+            self._words.append(result_words)
+            self._names.append((" ".join(words(names[0])), result_id))
+            for word in result_words:
+                self._ids_by_word.setdefault(word, []).append(result_id)
+            prefixes = {
+                word[:length]
+                for word in result_words
+                for length in range(1, min(len(word), SHORT_PREFIX_LENGTH) + 1)
+            }
+            for prefix in prefixes:
+                ids_by_short_prefix.setdefault(prefix, []).append(result_id)
+        self._names.sort()
+        self._ids_by_short_prefix = ids_by_short_prefix
+        self.terms = sorted(self._ids_by_word)
+
+    @classmethod
+    def build(cls):
+        entries = []
+        registry = Coding.objects.registry()
+        practice_codes = registry.objects(Practice)
+        practices = Practice.objects.order_by("pk").values_list("pk", "name")
+        for pk, name in practices:
+            ods_codes = [
+                code for system, code in practice_codes.get(pk, []) if system == "ods"
+            ]
+            if not ods_codes:
+                continue
+            cased_name = nhs_titlecase(name)
+            entries.append(
+                (
+                    SearchResult(cased_name, "practice", "ods/{}".format(ods_codes[0])),
+                    [cased_name, name],
+                    ods_codes,
+                )
+            )
+        for group in Group.objects.navigation():
+            if not group["code"]:
+                continue
+            entries.append(
+                (
+                    SearchResult(group["name"], group["kind"], group["code"]),
+                    [group["name"]],
+                    [group["code"].partition("/")[2]],
+                )
+            )
+        return cls(entries)
+
+    def _ids_with_prefix(self, prefix):
+        """Return an upper bound on the number of results with a word starting
+        with `prefix`, and an iterator over their ids in order (which may
+        repeat ids)
+
+        """
+        if len(prefix) <= SHORT_PREFIX_LENGTH:
+            ids = self._ids_by_short_prefix.get(prefix, [])
+            return len(ids), iter(ids)
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\uffff", lo=start)
+        id_lists = [self._ids_by_word[word] for word in self.terms[start:end]]
+        return sum(map(len, id_lists)), heapq.merge(*id_lists)
+
+    def search(self, query, limit):
+        """Return up to `limit` SearchResults matching `query`: exact code
+        matches first, then names starting with the query, then other
+        matches, each in name order
+
+        """
+        code_match = ENTITY_CODE_RE.match(query)
+        if code_match:
+            query = code_match.group("code")
+        query_words = words(query)
+        if not query_words:
+            return []
+        normalised_query = " ".join(query_words)
+        matched = list(self._ids_by_code.get(normalised_query, []))[:limit]
+
+        i = bisect.bisect_left(self._names, (normalised_query,))
+        while (
+            len(matched) < limit
+            and i < len(self._names)
+            and self._names[i][0].startswith(normalised_query)
+        ):
+            if self._names[i][1] not in matched:
+                matched.append(self._names[i][1])
+            i += 1
+
+        # Walk the results for the query word that matches fewest, checking
+        # the others against each result's words
+        ids_by_word = {word: self._ids_with_prefix(word) for word in query_words}
+        rarest = min(query_words, key=lambda word: ids_by_word[word][0])
+        others = [word for word in query_words if word != rarest]
+        for result_id in ids_by_word[rarest][1]:
+            if len(matched) >= limit:
+                break
+            if result_id not in matched and all(
+                any(word.startswith(other) for word in self._words[result_id])
+                for other in others
+            ):
+                matched.append(result_id)
+        return [self.results[result_id] for result_id in matched]
+
+
+_index = InProcessCache(lambda: SearchIndex.build())
+
+
+def get_search_index():
+    """Return the SearchIndex for the current data version, building it once
+    per process per version
+
+    """
+    return _index.get()
+
+
+def clear_search_index(**kwargs):
+    """Forget the current index, so the next search rebuilds it
+    """
+    _index.clear()
+
+
+# Changes made in this process take effect straight away; other processes
+# pick them up when the data version is bumped
+for model in (Coding, Group, Practice):
+    post_save.connect(clear_search_index, sender=model)
+    post_delete.connect(clear_search_index, sender=model)
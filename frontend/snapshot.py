@@ -0,0 +1,179 @@
+"""Serving pages from a read-only SQLite snapshot of the frontend tables.
+
+`./manage.py export_snapshot` copies practices, groups, codings, measures
+and the data version into an indexed SQLite file. When `SNAPSHOT_DATABASE`
+points at that file, it's configured as the `snapshot` database, and
+`SnapshotDatabaseMiddleware` marks read-only page requests so that
+`SnapshotRouter` sends their queries for those tables to it rather than
+over the network to the primary database. The admin, imports and other
+management commands keep reading and writing the primary database.
+
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+SNAPSHOT_ALIAS = "snapshot"
+SNAPSHOT_APP_LABELS = ("frontend", "contenttypes")
+SNAPSHOT_EXCLUDED_PREFIXES = ("/admin/",)
+BATCH_SIZE = 500
+
+_local = threading.local()
+
+
+def snapshot_configured():
+    return SNAPSHOT_ALIAS in settings.DATABASES
+
+
+@contextmanager
+def reading_from_snapshot():
+    """Send reads of the snapshotted tables in this thread to the snapshot
+    database for the duration of the block
+    """
+    previous = getattr(_local, "enabled", False)
+    _local.enabled = True
+    try:
+        yield
+    finally:
+        _local.enabled = previous
+
+
+class SnapshotRouter:
+    """Route reads of the frontend tables to the snapshot database, within
+    `reading_from_snapshot()`
+    """
+
+    def db_for_read(self, model, **hints):
+        if (
+            getattr(_local, "enabled", False)
+            and model._meta.app_label in SNAPSHOT_APP_LABELS
+        ):
+            return SNAPSHOT_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db != SNAPSHOT_ALIAS
+
+
+class SnapshotDatabaseMiddleware:
+    """Serve GET and HEAD requests, other than for the admin, from the
+    snapshot database
+    """
+
+    def __init__(self, get_response):
+        if not snapshot_configured():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in ("GET", "HEAD") and not request.path_info.startswith(
+            SNAPSHOT_EXCLUDED_PREFIXES
+        ):
+            with reading_from_snapshot():
+                return self.get_response(request)
+        return self.get_response(request)
+
+
+def snapshot_models():
+    """Return the models copied into the snapshot, including the tables
+    behind many-to-many fields, in an order that satisfies foreign keys
+    """
+    models = []
+    for app_label in SNAPSHOT_APP_LABELS:
+        for model in apps.get_app_config(app_label).get_models():
+            models.append(model)
+            for field in model._meta.local_many_to_many:
+                if field.remote_field.through._meta.auto_created:
+                    models.append(field.remote_field.through)
+    return sorted(models, key=lambda model: model._meta.app_label != "contenttypes")
+
+
+def _copy_rows(model, source, connection):
+    fields = model._meta.concrete_fields
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        connection.ops.quote_name(model._meta.db_table),
+        columns,
+        ", ".join(["%s"] * len(fields)),
+    )
+    rows = (
+        model._default_manager.using(source)
+        .order_by("pk")
+        .values_list(*[field.attname for field in fields])
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    count = 0
+    with connection.cursor() as cursor:
+        batch = []
+        for row in rows:
+            batch.append(
+                [
+                    field.get_db_prep_save(value, connection=connection)
+                    for field, value in zip(fields, row)
+                ]
+            )
+            if len(batch) == BATCH_SIZE:
+                cursor.executemany(sql, batch)
+                count += len(batch)
+                batch = []
+        cursor.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def export_snapshot(path, using="default"):
+    """Write the snapshotted tables from database `using` to a new SQLite
+    file at `path`, replacing any file already there.
+
+    Returns a dict of the number of rows copied for each table.
+
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    alias = "snapshot_export"
+    connections.databases[alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": tmp_path,
+    }
+    connection = connections[alias]
+    counts = {}
+    try:
+        models = snapshot_models()
+        with connection.schema_editor() as editor:
+            # Creating a model also creates the tables for its
+            # many-to-many fields
+            for model in models:
+                if not model._meta.auto_created:
+                    editor.create_model(model)
+        connection.set_autocommit(False)
+        for model in models:
+            counts[model._meta.db_table] = _copy_rows(model, using, connection)
+        connection.commit()
+        connection.set_autocommit(True)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            cursor.execute("PRAGMA integrity_check")
+            result = cursor.fetchone()[0]
+    finally:
+        connection.close()
+        del connections[alias]
+        del connections.databases[alias]
+    if result != "ok":
+        raise ValueError("Snapshot failed integrity check: {}".format(result))
+    # Replace any existing snapshot in one step, so it's never seen half
+    # written
+    os.replace(tmp_path, path)
+    return counts
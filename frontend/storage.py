@@ -0,0 +1,89 @@
+"""Static files storage that makes repeated `collectstatic` runs cheap.
+
+The chart directory is part of `STATICFILES_DIRS`, so every deploy collects
+thousands of charts. WhiteNoise's storage hashes every file on every run,
+and compresses every compressible file again even when it hasn't changed.
+This storage remembers each source file's size, mtime and hash in
+`HASH_CACHE` under `STATIC_ROOT`, reuses the hash while the size and mtime
+are unchanged, and doesn't recompress files whose compressed versions are
+newer than they are. Already-compressed formats (PNG, WebP and the like)
+are never compressed, per `WHITENOISE_SKIP_COMPRESS_EXTENSIONS`.
+
+"""
+import json
+import os
+
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+HASH_CACHE = "staticfiles.hashes.json"
+COMPRESSED_SUFFIXES = (".gz", ".br")
+
+
+class IncrementalCompressedManifestStaticFilesStorage(
+    CompressedManifestStaticFilesStorage
+):
+    _hash_cache = None
+
+    def post_process(self, *args, **kwargs):
+        dry_run = kwargs.get("dry_run")
+        if not dry_run:
+            self._hash_cache = self._load_hash_cache()
+        try:
+            yield from super().post_process(*args, **kwargs)
+            if not dry_run:
+                self._save_hash_cache()
+        finally:
+            self._hash_cache = None
+
+    def file_hash(self, name, content=None):
+        """Return the hash of a file being collected, reusing the one from
+        the last run if its source's size and mtime haven't changed
+        """
+        source = getattr(content, "name", None)
+        if self._hash_cache is None or not source or not os.path.isabs(source):
+            return super().file_hash(name, content)
+        stat = os.stat(source)
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = self._hash_cache.get(name)
+        if cached and cached[:2] == key:
+            return cached[2]
+        file_hash = super().file_hash(name, content)
+        self._hash_cache[name] = key + [file_hash]
+        return file_hash
+
+    def compress_files(self, names):
+        return super().compress_files(
+            [name for name in names if not self._compressed_up_to_date(name)]
+        )
+
+    def _compressed_up_to_date(self, name):
+        path = self.path(name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        compressed = [
+            path + suffix
+            for suffix in COMPRESSED_SUFFIXES
+            if os.path.exists(path + suffix)
+        ]
+        return bool(compressed) and all(
+            os.stat(compressed_path).st_mtime_ns >= mtime
+            for compressed_path in compressed
+        )
+
+    def _load_hash_cache(self):
+        try:
+            with self.open(HASH_CACHE) as f:
+                return json.loads(f.read().decode("utf-8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_hash_cache(self):
+        path = self.path(HASH_CACHE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._hash_cache, f)
+        os.replace(tmp_path, path)
@@ -1,19 +1,55 @@
+import asyncio
+import hashlib
+import json
 import lxml.html
+import numpy as np
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 from contextlib import contextmanager
+from io import StringIO
+from unittest.mock import Mock
 from unittest.mock import patch
 
 
 from django.urls import reverse
+from PIL import Image
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management import CommandError
+from django.core.signals import request_finished
+from django.db import connection
+from django.test import SimpleTestCase
 from django.test import TestCase
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
+from frontend.charts import clear_chart_index
+from frontend.management.commands.benchmark import compare_results
+from frontend.management.commands.benchmark import run_benchmarks
+from frontend.management.commands.fetch_blog_entries import fetch_page
+from frontend.management.commands.fetch_blog_entries import make_internal_link_rewriter
+from frontend.charts import get_chart_index
 from frontend.models import Practice
 from frontend.models import Group
 from frontend.models import GroupKind
 from frontend.models import Coding
+from frontend.models import DataVersion
 from frontend.models import Measure
+from frontend.search import SearchIndex
+from frontend.search import SearchResult
+from frontend.snapshot import SnapshotRouter
+from frontend.snapshot import reading_from_snapshot
+from frontend.timeseries import MeasureValues
+from frontend.timeseries import write_measure_values
+from frontend.views import chart_file_src
+from openpath import asgi
 
 
 def create_ccg():
@@ -50,9 +86,17 @@ def create_measure_with_practices():
         yield measure
 
 
+def chart_src(filename):
+    """Return the URL of a chart created by `chart_fixtures`
+    """
+    content_hash = hashlib.sha256(filename.encode("utf-8")).hexdigest()[:16]
+    return reverse("chart", kwargs={"content_hash": content_hash, "extension": "png"})
+
+
 @contextmanager
 def chart_fixtures(full_paths):
-    """Create empty files at the specified paths; remove the files on completion.
+    """Create files containing their own names at the specified paths; remove
+    the files on completion.
 
     """
     try:
@@ -60,16 +104,21 @@ def chart_fixtures(full_paths):
             location, filename = os.path.split(full_path)
             os.makedirs(location, exist_ok=True)
             with open(full_path, "w") as f:
-                f.write("test")
+                f.write(filename)
+        clear_chart_index()
         yield
 
     finally:
         for full_path in full_paths:
             location, filename = os.path.split(full_path)
             os.remove(full_path)
+        clear_chart_index()
 
 
 class ModelTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test_filter_by_entity_code(self):
         ccg = create_ccg()
         practice = create_practice(ccg=ccg, code="01")
@@ -79,12 +128,273 @@ class ModelTests(TestCase):
         )
         self.assertEqual(str(practice.groups.first().codes.first()), "ods/RG5")
 
+    def test_filter_by_multiple_entity_codes(self):
+        ccg = create_ccg()
+        lab = Group.objects.create(
+            name="My lab", kind=GroupKind.objects.create(name="lab")
+        )
+        Coding(content_object=lab, system="lab", code="REF").save()
+        practice1 = create_practice(ccg=ccg, code="01")
+        practice2 = create_practice(ccg=ccg, code="02")
+        practice2.groups.add(lab)
+        membership = Practice.objects.membership()
+        self.assertEqual(membership.practice_codes(), {"01", "02"})
+        self.assertEqual(membership.practice_codes(["ods/RG5"]), {"01", "02"})
+        self.assertEqual(membership.practice_codes(["ods/RG5", "lab/REF"]), {"02"})
+        self.assertEqual(membership.practice_codes(["ods/01", "lab/REF"]), set())
+        self.assertEqual(membership.practice_codes(["ods/nonexistent"]), set())
+        self.assertEqual(membership.practice_ids(["ods/01"]), [practice1.pk])
+        # Held in memory until the data version changes, or this process
+        # changes memberships
+        with self.assertNumQueries(1):
+            self.assertIs(Practice.objects.membership(), membership)
+        practice1.groups.add(lab)
+        self.assertEqual(
+            Practice.objects.membership().practice_codes(["lab/REF"]), {"01", "02"}
+        )
+
+    def test_group_navigation(self):
+        ccg = create_ccg()
+        GroupKind.objects.create(name="lab")
+        Group.objects.create(name="Empty lab", kind=GroupKind.objects.get(name="lab"))
+        create_practice(ccg=ccg, code="01")
+        expected = [
+            {"code": "ods/RG5", "name": "My CCG", "kind": "ccg", "practice_count": 1}
+        ]
+        self.assertEqual(Group.objects.navigation(), expected)
+        create_practice(ccg=ccg, code="02")
+        with self.assertNumQueries(1):
+            self.assertEqual(Group.objects.navigation(), expected)
+        DataVersion.bump()
+        self.assertEqual(Group.objects.navigation()[0]["practice_count"], 2)
+
     @override_settings(PREGENERATED_CHARTS_ROOT="/tmp/test_charts/")
     def test_chart_urls(self):
         with create_measure_with_practices() as measure:
             self.assertEqual(
                 measure.chart_urls(), ["testmeasure_02_01.png", "testmeasure_01_02.png"]
             )
+            self.assertEqual(
+                measure.chart_urls(ods_practice_codes=["01"]), ["testmeasure_01_02.png"]
+            )
+
+    @override_settings(PREGENERATED_CHARTS_ROOT="/tmp/test_charts/")
+    def test_coding_registry(self):
+        with create_measure_with_practices():
+            practice = Practice.objects.get_by_entity_code("ods/01")
+            with self.assertNumQueries(1):
+                self.assertEqual(practice.ods_code(), "01")
+            with self.assertNumQueries(2):
+                practice = Practice.objects.get_by_entity_code("ods/02")
+            self.assertEqual(practice.name, "My practice 02")
+            registry = Coding.objects.registry()
+            self.assertIsNone(registry.object_id(Practice, "ods", "RG5"))
+            self.assertIsNotNone(registry.object_id(Group, "ods", "RG5"))
+            create_practice(code="03")
+            practice = Practice.objects.get_by_entity_code("ods/03")
+            self.assertEqual(practice.ods_code(), "03")
+
+    def test_display_fields(self):
+        practice = Practice(
+            name="DR SMITH & PTNRS NHS CCG SURGERY",
+            address1="1 HIGH STREET",
+            address3="LEEDS",
+            postcode="LS1 1AA",
+        )
+        self.assertEqual(practice.cased_name, "Dr Smith & PTNRS NHS CCG Surgery")
+        self.assertEqual(practice.address_pretty(), "1 HIGH STREET, LEEDS, LS1 1AA")
+        self.assertEqual(practice.address_pretty_minus_firstline(), "LEEDS, LS1 1AA")
+        for address1 in ("", None):
+            practice.address1 = address1
+            self.assertEqual(practice.address_pretty(), "LEEDS, LS1 1AA")
+
+    @override_settings(PREGENERATED_CHARTS_ROOT="/tmp/test_charts/")
+    def test_chart_index(self):
+        paths = [
+            os.path.join(settings.PREGENERATED_CHARTS_ROOT, filename)
+            for filename in [
+                "measure_a_01_3.png",
+                "othermeasure_01_1.png",
+                "othermeasure_02_2.png",
+                "othermeasure_02_notarank.png",
+            ]
+        ]
+        with chart_fixtures(paths):
+            index = get_chart_index()
+            self.assertIs(get_chart_index(), index)
+            self.assertEqual(len(index), 3)
+            self.assertEqual(
+                [x.url for x in index.for_practices(["01"])],
+                ["othermeasure_01_1.png", "measure_a_01_3.png"],
+            )
+            chart = index.for_measure("measure_a")[0]
+            self.assertEqual((chart.practice_code, chart.rank), ("01", 3))
+            self.assertEqual(
+                [x.url for x in index.for_measure("othermeasure", ["02", "03"])],
+                ["othermeasure_02_2.png"],
+            )
+
+    @override_settings(
+        PREGENERATED_CHARTS_ROOT="/tmp/test_charts/", CHART_RELOAD_INTERVAL=0
+    )
+    def test_chart_index_reloaded_when_directory_changes(self):
+        path = os.path.join(settings.PREGENERATED_CHARTS_ROOT, "m_01_1.png")
+        new_path = os.path.join(settings.PREGENERATED_CHARTS_ROOT, "m_02_2.png")
+        with chart_fixtures([path]):
+            index = get_chart_index()
+            self.assertIs(get_chart_index(), index)
+            try:
+                with open(new_path, "w") as f:
+                    f.write("new")
+                added = get_chart_index()
+                self.assertEqual(len(added), 2)
+                self.assertNotEqual(added.signature, index.signature)
+                # Replacing a chart by renaming a new file over it
+                with open(path + ".tmp", "w") as f:
+                    f.write("replaced")
+                os.replace(path + ".tmp", path)
+                replaced = get_chart_index()
+                self.assertEqual(len(replaced), 2)
+                self.assertNotEqual(replaced.signature, added.signature)
+                # Not checked again until the interval has passed
+                with override_settings(CHART_RELOAD_INTERVAL=60):
+                    self.assertIs(get_chart_index(), replaced)
+                    os.remove(new_path)
+                    self.assertIs(get_chart_index(), replaced)
+                    replaced.next_check = 0
+                    self.assertEqual(len(get_chart_index()), 1)
+            finally:
+                if os.path.exists(new_path):
+                    os.remove(new_path)
+
+    @override_settings(PREGENERATED_CHARTS_ROOT="/tmp/test_charts/")
+    def test_chart_index_kept_when_reload_fails(self):
+        path = os.path.join(settings.PREGENERATED_CHARTS_ROOT, "m_01_1.png")
+        new_path = os.path.join(settings.PREGENERATED_CHARTS_ROOT, "m_02_2.png")
+        with chart_fixtures([path]):
+            index = get_chart_index()
+            try:
+                with open(new_path, "w") as f:
+                    f.write("new")
+                with patch("frontend.charts._file_hash", side_effect=OSError):
+                    with override_settings(CHART_RELOAD_INTERVAL=60):
+                        with self.assertLogs("frontend.charts", "ERROR"):
+                            self.assertIs(get_chart_index(), index)
+                        self.assertGreater(index.next_check, time.monotonic())
+                        # Only checked again after the interval
+                        self.assertIs(get_chart_index(), index)
+                    # The first build has nothing to fall back on
+                    clear_chart_index()
+                    with self.assertRaises(OSError):
+                        get_chart_index()
+                self.assertEqual(len(get_chart_index()), 2)
+            finally:
+                if os.path.exists(new_path):
+                    os.remove(new_path)
+                clear_chart_index()
+
+    @override_settings(PREGENERATED_CHARTS_ROOT="/tmp/test_charts/")
+    def test_chart_index_ignores_invalid_manifests(self):
+        path = os.path.join(settings.PREGENERATED_CHARTS_ROOT, "m_01_1.png")
+        manifest_paths = [
+            os.path.join(settings.PREGENERATED_CHARTS_ROOT, ".charts.json"),
+            os.path.join(settings.PREGENERATED_CHARTS_ROOT, ".optimised.json"),
+        ]
+        with chart_fixtures([path]):
+            try:
+                for content in ["{not json", "[]"]:
+                    for manifest_path in manifest_paths:
+                        with open(manifest_path, "w") as f:
+                            f.write(content)
+                    clear_chart_index()
+                    with self.assertLogs("frontend.charts", "ERROR") as logs:
+                        index = get_chart_index()
+                    self.assertEqual(len(logs.output), 2)
+                    chart = index.for_measure("m")[0]
+                    self.assertEqual((chart.practice_code, chart.rank), ("01", 1))
+                    self.assertIsNone(index.srcsets(chart))
+            finally:
+                for manifest_path in manifest_paths:
+                    if os.path.exists(manifest_path):
+                        os.remove(manifest_path)
+                clear_chart_index()
+
+    @override_settings(PREGENERATED_CHARTS_ROOT="/tmp/test_charts/")
+    def test_chart_metadata_sort_orders(self):
+        paths = [
+            os.path.join(settings.PREGENERATED_CHARTS_ROOT, filename)
+            for filename in [
+                "m_01_1.png",
+                "m_02_2.png",
+                "m_03_3.png",
+                "m_04.png",
+                "m_05.png",
+            ]
+        ]
+        metadata = {
+            "charts": {
+                "m_01_1.png": {"latest_value": 0.5, "practice_name": "Beech"},
+                "m_02_2.png": {"latest_value": 0.9, "practice_name": "Ash"},
+                # No rank, so described by its filename; and a latest_value
+                # that can't be compared with the others
+                "m_03_3.png": {
+                    "measure_id": "m",
+                    "practice_code": "03",
+                    "latest_value": "n/a",
+                    "practice_name": "Cedar",
+                },
+                "m_04.png": {
+                    "measure_id": "m",
+                    "practice_code": "04",
+                    "rank": 4,
+                    "latest_value": 0.1,
+                },
+                # An invalid rank, and not a chart filename
+                "m_05.png": {"measure_id": "m", "practice_code": "05", "rank": "1st"},
+            }
+        }
+        for filename in ["m_01_1.png", "m_02_2.png"]:
+            metadata["charts"][filename].update(
+                measure_id="m", practice_code=filename[2:4], rank=int(filename[5])
+            )
+        metadata_path = os.path.join(settings.PREGENERATED_CHARTS_ROOT, ".charts.json")
+        with chart_fixtures(paths):
+            with open(metadata_path, "w") as f:
+                json.dump(metadata, f)
+            try:
+                clear_chart_index()
+                index = get_chart_index()
+                self.assertEqual(
+                    index.sort_orders,
+                    [
+                        "rank",
+                        "-rank",
+                        "latest_value",
+                        "-latest_value",
+                        "practice_name",
+                        "-practice_name",
+                    ],
+                )
+
+                def codes(**kwargs):
+                    return [x.practice_code for x in index.for_measure("m", **kwargs)]
+
+                self.assertEqual(codes(), ["01", "02", "03", "04"])
+                self.assertEqual(codes(sort="-rank"), ["04", "03", "02", "01"])
+                # Charts without a value come last, in rank order
+                self.assertEqual(codes(sort="latest_value"), ["04", "01", "02", "03"])
+                self.assertEqual(codes(sort="-latest_value"), ["02", "01", "04", "03"])
+                self.assertEqual(codes(sort="practice_name"), ["02", "01", "03", "04"])
+                self.assertEqual(
+                    codes(practice_codes=["01", "02"], sort="-latest_value"),
+                    ["02", "01"],
+                )
+                self.assertEqual(index.metadata["m_04.png"], {"latest_value": 0.1})
+                self.assertNotIn("m_05.png", index.stats)
+                with self.assertRaises(ValueError):
+                    index.for_measure("m", sort="colour")
+            finally:
+                os.remove(metadata_path)
 
 
 @override_settings(
@@ -92,6 +402,9 @@ class ModelTests(TestCase):
     STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
 )
 class ViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test_measures(self):
         with create_measure_with_practices() as measure:
             response = self.client.get(reverse("measures"))
@@ -108,8 +421,150 @@ class ViewTests(TestCase):
             links = html.xpath("//img[contains(@class, 'measure-chart')]/@src")
             self.assertEqual(
                 links,
-                ["/static/testmeasure_02_01.png", "/static/testmeasure_01_02.png"],
+                [
+                    chart_src("testmeasure_02_01.png"),
+                    chart_src("testmeasure_01_02.png"),
+                ],
+            )
+
+    def test_measure_sorted(self):
+        with create_measure_with_practices() as measure:
+            url = reverse("measure", kwargs={"measure": measure.id})
+            response = self.client.get(url + "?sort=-rank")
+            html = lxml.html.document_fromstring(response.content)
+            links = html.xpath("//img[contains(@class, 'measure-chart')]/@src")
+            self.assertEqual(
+                links,
+                [
+                    chart_src("testmeasure_01_02.png"),
+                    chart_src("testmeasure_02_01.png"),
+                ],
+            )
+            response = self.client.get(url + "?sort=unknown")
+            html = lxml.html.document_fromstring(response.content)
+            links = html.xpath("//img[contains(@class, 'measure-chart')]/@src")
+            self.assertEqual(links[0], chart_src("testmeasure_02_01.png"))
+
+    def test_measure_query_count_independent_of_practices(self):
+        with create_measure_with_practices() as measure:
+            url = reverse("measure", kwargs={"measure": measure.id})
+            with CaptureQueriesContext(connection) as two_practices:
+                self.client.get(url)
+            ccg = Group.objects.get()
+            for code in ["03", "04", "05"]:
+                create_practice(ccg=ccg, code=code)
+            DataVersion.bump()
+            with CaptureQueriesContext(connection) as five_practices:
+                self.client.get(url)
+            self.assertEqual(len(two_practices), len(five_practices))
+
+    def test_measure_cached_until_data_version_changes(self):
+        with create_measure_with_practices() as measure:
+            url = reverse("measure", kwargs={"measure": measure.id})
+            response = self.client.get(url)
+            Measure.objects.filter(pk=measure.pk).update(title="New title")
+            with self.assertNumQueries(1):
+                cached = self.client.get(url)
+            self.assertEqual(cached.content, response.content)
+            self.assertNotEqual(
+                self.client.get(url + "?filter=ods/01").content, response.content
+            )
+            DataVersion.bump()
+            self.assertContains(self.client.get(url), "New title")
+
+    def test_prerendered_pages(self):
+        with create_measure_with_practices() as measure, tempfile.TemporaryDirectory() as output_dir:
+            # A practice with no charts still has a page
+            create_practice(code="03")
+            out = StringIO()
+            call_command(
+                "prerender_pages",
+                "--output-dir",
+                output_dir,
+                "--workers",
+                "1",
+                stdout=out,
+            )
+            # measures/, the measure with and without the CCG filter, the
+            # measure without data, and three practice pages
+            self.assertIn("Rendered 8 pages", out.getvalue())
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(
+                        output_dir, "measure", "testmeasure", "filter=ods%2FRG5.html"
+                    )
+                )
+            )
+            for args, count in [
+                (["--measure", "testmeasure"], 5),
+                # Both measures with and without the filter, and the
+                # practices in the group
+                (["--group", "ods/RG5"], 6),
+            ]:
+                out = StringIO()
+                call_command(
+                    "prerender_pages",
+                    "--output-dir",
+                    output_dir,
+                    "--workers",
+                    "1",
+                    *args,
+                    stdout=out
+                )
+                self.assertIn("Rendered {} pages".format(count), out.getvalue())
+
+            url = reverse("measure", kwargs={"measure": measure.id})
+            expected = self.client.get(url + "?filter=ods/RG5").content
+            with override_settings(PRERENDERED_PAGES_ROOT=output_dir):
+                self.client = self.client_class()
+                with self.assertNumQueries(0):
+                    response = self.client.get(url + "?filter=ods/RG5")
+                self.assertEqual(response["X-Prerendered"], "1")
+                self.assertEqual(response["X-Frame-Options"], "SAMEORIGIN")
+                self.assertEqual(
+                    response["Cache-Control"],
+                    self.client.get(url + "?filter=ods/01")["Cache-Control"],
+                )
+                self.assertEqual(b"".join(response.streaming_content), expected)
+                self.assertEqual(int(response["Content-Length"]), len(expected))
+                response = self.client.get(url + "?filter=ods/01")
+                self.assertFalse(response.has_header("X-Prerendered"))
+                # Pages rendered for old data aren't served
+                DataVersion.bump()
+                response = self.client.get(url + "?filter=ods/RG5")
+                self.assertFalse(response.has_header("X-Prerendered"))
+
+    @override_settings(CHARTS_PER_PAGE=1)
+    def test_measure_paginated(self):
+        with create_measure_with_practices() as measure:
+            # Other parameters aren't part of the cache key, so they mustn't
+            # end up in links on the cached page
+            response = self.client.get(
+                reverse("measure", kwargs={"measure": measure.id})
+                + "?filter=ods/RG5&utm_source=x"
+            )
+            html = lxml.html.document_fromstring(response.content)
+            self.assertEqual(
+                html.xpath("//img[contains(@class, 'measure-chart')]/@src"),
+                [chart_src("testmeasure_02_01.png")],
+            )
+            self.assertEqual(
+                html.xpath("//img[contains(@class, 'measure-chart')]/@loading"),
+                ["lazy"],
+            )
+            fragment_url = html.xpath("//a[contains(@class, 'more-charts')]")[0].get(
+                "data-fragment-url"
+            )
+            self.assertEqual(
+                fragment_url, "/measure/testmeasure/charts?filter=ods%2FRG5&page=2"
+            )
+            response = self.client.get(fragment_url)
+            html = lxml.html.fragment_fromstring(response.content, create_parent=True)
+            self.assertEqual(
+                html.xpath("//img[contains(@class, 'measure-chart')]/@src"),
+                [chart_src("testmeasure_01_02.png")],
             )
+            self.assertEqual(html.xpath("//a[contains(@class, 'more-charts')]"), [])
 
     def test_non_matching_measure_all_practices(self):
         with create_measure_with_practices() as measure:
@@ -117,7 +572,9 @@ class ViewTests(TestCase):
                 reverse("measure", kwargs={"measure": "has_no_data"})
             )
             self.assertEqual(response.status_code, 200)
-            self.assertNotContains(response, 'src="/static/testmeasure_01_02.png"')
+            self.assertNotContains(
+                response, 'src="{}"'.format(chart_src("testmeasure_01_02.png"))
+            )
 
     def test_measure_single_practice(self):
         with create_measure_with_practices() as measure:
@@ -125,8 +582,25 @@ class ViewTests(TestCase):
                 reverse("measure", kwargs={"measure": measure.id}) + "?filter=ods/01"
             )
             self.assertEqual(response.status_code, 200)
-            self.assertContains(response, 'src="/static/testmeasure_01_02.png"')
-            self.assertNotContains(response, 'src="/static/testmeasure_02_01.png"')
+            self.assertContains(
+                response, 'src="{}"'.format(chart_src("testmeasure_01_02.png"))
+            )
+            self.assertNotContains(
+                response, 'src="{}"'.format(chart_src("testmeasure_02_01.png"))
+            )
+
+    def test_measure_group_filter(self):
+        with create_measure_with_practices() as measure:
+            response = self.client.get(
+                reverse("measure", kwargs={"measure": measure.id}) + "?filter=ods/RG5"
+            )
+            html = lxml.html.document_fromstring(response.content)
+            links = html.xpath("//img[contains(@class, 'measure-chart')]/@src")
+            self.assertEqual(len(links), 2)
+            self.assertEqual(
+                html.xpath("//a[contains(@class, 'nav-link active')]/text()"),
+                ["My CCG (ccg)"],
+            )
 
     def test_measure_no_matching_practices(self):
         with create_measure_with_practices() as measure:
@@ -143,5 +617,803 @@ class ViewTests(TestCase):
             response = self.client.get(
                 reverse("practice", kwargs={"practice": "ods/01"})
             )
-            self.assertContains(response, 'src="/static/testmeasure_01_02.png"')
-            self.assertNotContains(response, 'src="/static/testmeasure_02_01.png"')
+            self.assertContains(
+                response, 'src="{}"'.format(chart_src("testmeasure_01_02.png"))
+            )
+            self.assertNotContains(
+                response, 'src="{}"'.format(chart_src("testmeasure_02_01.png"))
+            )
+
+    def test_chart(self):
+        with create_measure_with_practices():
+            url = chart_src("testmeasure_01_02.png")
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                b"".join(response.streaming_content), b"testmeasure_01_02.png"
+            )
+            self.assertEqual(response["Content-Type"], "image/png")
+            self.assertEqual(
+                response["Cache-Control"], "public, max-age=31536000, immutable"
+            )
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(
+                response["Cache-Control"], "public, max-age=31536000, immutable"
+            )
+            response = self.client.get(
+                reverse(
+                    "chart",
+                    kwargs={"content_hash": "0123456789abcdef", "extension": "png"},
+                )
+            )
+            self.assertEqual(response.status_code, 404)
+            response = self.client.get(url.replace(".png", ".webp"))
+            self.assertEqual(response.status_code, 404)
+
+            # A chart rewritten in place isn't served under its old hash, and
+            # is hashed again
+            path = os.path.join(
+                settings.PREGENERATED_CHARTS_ROOT, "testmeasure_01_02.png"
+            )
+            with open(path, "w") as f:
+                f.write("rewritten")
+            self.assertEqual(self.client.get(url).status_code, 404)
+            response = self.client.get(chart_src("rewritten"))
+            self.assertEqual(b"".join(response.streaming_content), b"rewritten")
+
+
+PRACTICES_CSV = """practice_ods_code,practice_name,ccg_ods_code,ccg_name,lab_code,lab_name
+01,Practice 1,11N,NHS Kernow CCG,REF,Royal Cornwall
+02,Practice 2,15N,NHS Devon CCG,REF,Royal Cornwall
+"""
+
+
+@override_settings(
+    PREGENERATED_CHARTS_ROOT="/tmp/test_charts/",
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+    SERVER_TIMING=True,
+    SLOW_REQUEST_MS=60000,
+)
+class ServerTimingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_server_timing(self):
+        with create_measure_with_practices():
+            with self.assertLogs("frontend.instrumentation", "INFO") as logs:
+                response = self.client.get(
+                    reverse("measure", kwargs={"measure": "testmeasure"})
+                )
+        metrics = [x.split(";")[0] for x in response["Server-Timing"].split(", ")]
+        self.assertEqual(metrics, ["sql", "chart_index", "charts", "template", "total"])
+        self.assertIn('desc="', response["Server-Timing"])
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("path=/measure/testmeasure status=200", logs.output[0])
+        self.assertGreater(logs.records[0].timings["sql_queries"], 0)
+
+    def test_slow_request_logs_queries(self):
+        with create_measure_with_practices():
+            with self.settings(SLOW_REQUEST_MS=-1):
+                with self.assertLogs("frontend.instrumentation", "WARNING") as logs:
+                    self.client.get(
+                        reverse("measure", kwargs={"measure": "testmeasure"})
+                    )
+        self.assertIn("slow request", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def import_practices(self, content, *args):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write(content)
+            f.flush()
+            out = StringIO()
+            call_command("import_practices", "--filename", f.name, *args, stdout=out)
+        return out.getvalue()
+
+    def assert_imported(self):
+        membership = Practice.objects.membership()
+        self.assertEqual(membership.practice_codes(["lab/REF"]), {"01", "02"})
+        self.assertEqual(membership.practice_codes(["ods/15N"]), {"02"})
+        self.assertEqual(
+            [(x["code"], x["name"], x["kind"]) for x in Group.objects.navigation()],
+            [
+                ("ods/11N", "NHS Kernow CCG", "ccg"),
+                ("lab/REF", "Royal Cornwall", "lab"),
+                ("ods/15N", "NHS Devon CCG", "ccg"),
+            ],
+        )
+
+    def test_import_practices(self):
+        self.import_practices(PRACTICES_CSV)
+        self.assert_imported()
+
+    def test_import_practices_bulk(self):
+        output = self.import_practices(PRACTICES_CSV, "--bulk")
+        self.assertIn("practices created: 2", output)
+        self.assertIn("memberships created: 4", output)
+        self.assert_imported()
+
+        version = DataVersion.current()
+        self.import_practices(PRACTICES_CSV, "--bulk")
+        self.assertEqual(DataVersion.current(), version)
+
+        output = self.import_practices(
+            PRACTICES_CSV.replace("Practice 2", "Practice Two"), "--bulk"
+        )
+        self.assertIn("practices created: 0", output)
+        self.assertIn("practices updated: 1", output)
+        self.assertIn("memberships created: 0", output)
+        self.assertEqual(
+            Practice.objects.get_by_entity_code("ods/02").name, "Practice Two"
+        )
+        self.assertEqual(DataVersion.current(), version + 1)
+
+
+BLOG_ENTRIES_YAML = """---
+title: "First post"
+url: https://example.com/blog/first-post/
+slug: first-post
+xpath: //div[@class="entry-content"]
+date: 2019-09-02
+---
+title: "Second post"
+url: https://example.com/blog/second-post/
+slug: second-post
+xpath: //div[@class="entry-content"]
+date: 2019-09-09
+"""
+
+BLOG_PAGE_HTML = """<html><body><div class="entry-content">
+<p>{} <a href="https://example.com/blog/first-post/">the first post</a></p>
+</div></body></html>"""
+
+
+class FetchBlogEntriesTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.entries = os.path.join(self.tmp.name, "entries.yaml")
+        with open(self.entries, "w") as f:
+            f.write(BLOG_ENTRIES_YAML)
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.template_dir = os.path.join(self.tmp.name, "templates")
+        os.makedirs(self.cache_dir)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fetch(self, *args):
+        out = StringIO()
+        call_command(
+            "fetch_blog_entries",
+            "--entries",
+            self.entries,
+            "--cache-dir",
+            self.cache_dir,
+            "--template-dir",
+            self.template_dir,
+            *args,
+            stdout=out
+        )
+        return out.getvalue()
+
+    def test_conditional_fetch(self):
+        page = {"url": "https://example.com/blog/first-post/", "slug": "first-post"}
+        session = Mock()
+        session.get.return_value = Mock(
+            status_code=200, text="<p>hello</p>", headers={"ETag": '"abc"'}
+        )
+        self.assertEqual(
+            fetch_page(session, self.cache_dir, page, 5), ("<p>hello</p>", False)
+        )
+        session.get.return_value = Mock(status_code=304, headers={})
+        self.assertEqual(
+            fetch_page(session, self.cache_dir, page, 5), ("<p>hello</p>", True)
+        )
+        session.get.assert_called_with(
+            page["url"], headers={"If-None-Match": '"abc"'}, timeout=5
+        )
+
+    def test_offline_requires_cache(self):
+        with self.assertRaises(CommandError):
+            self.fetch("--offline")
+
+    def test_offline(self):
+        for slug in ["first-post", "second-post"]:
+            with open(os.path.join(self.cache_dir, slug + ".html"), "w") as f:
+                f.write(BLOG_PAGE_HTML.format(slug))
+        output = self.fetch("--offline")
+        self.assertIn("3 added", output)
+        with open(os.path.join(self.template_dir, "blog", "second-post.html")) as f:
+            content = f.read()
+        self.assertIn("<h1>Second post</h1>", content)
+        self.assertIn('href="/first-post', content)
+        with open(os.path.join(self.template_dir, "blog.html")) as f:
+            content = f.read()
+        self.assertLess(content.index("Second post"), content.index("First post"))
+
+        with open(os.path.join(self.cache_dir, "first-post.html"), "w") as f:
+            f.write(BLOG_PAGE_HTML.format("changed"))
+        output = self.fetch("--offline")
+        # The index is updated too, as it includes a summary of each post
+        self.assertIn("2 updated: blog/first-post.html, blog.html", output)
+        self.assertIn("1 skipped: blog/second-post.html", output)
+
+    def test_internal_link_rewriter(self):
+        rewrite = make_internal_link_rewriter(
+            [
+                {"url": "https://example.com/blog/post/", "slug": "post"},
+                {"url": "https://example.com/blog/post-two", "slug": "two"},
+            ]
+        )
+        self.assertEqual(
+            rewrite(
+                '<a href="https://example.com/blog/post/">a</a> '
+                '<a href="https://example.com/blog/post-two">b</a> '
+                '<a href="https://elsewhere.com/">c</a>'
+            ),
+            '<a href="/post/">a</a> <a href="/two">b</a> '
+            '<a href="https://elsewhere.com/">c</a>',
+        )
+
+
+class OptimiseChartsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        for filename in ["testmeasure_01_02.png", "testmeasure_02_01.png"]:
+            Image.new("RGBA", (432, 288), "white").save(
+                os.path.join(self.tmp.name, filename)
+            )
+        clear_chart_index()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        clear_chart_index()
+
+    def optimise(self):
+        out = StringIO()
+        with override_settings(PREGENERATED_CHARTS_ROOT=self.tmp.name):
+            call_command("optimise_charts", "--workers", "1", stdout=out)
+        return out.getvalue()
+
+    def test_optimise_charts(self):
+        self.assertIn("Optimised 2 charts (0 unchanged, 0 renamed)", self.optimise())
+        for filename in [
+            "testmeasure_01_02.webp",
+            "testmeasure_01_02.216w.png",
+            "testmeasure_01_02.324w.webp",
+        ]:
+            self.assertTrue(os.path.exists(os.path.join(self.tmp.name, filename)))
+        self.assertIn("Optimised 0 charts (2 unchanged, 0 renamed)", self.optimise())
+
+        with override_settings(
+            PREGENERATED_CHARTS_ROOT=self.tmp.name,
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+        ):
+            # The hashes recorded by optimise_charts are used, rather than
+            # reading the charts again
+            with patch("frontend.charts._file_hash") as file_hash:
+                index = get_chart_index()
+            file_hash.assert_not_called()
+            self.assertEqual(len(index), 2)
+            create_practice(code="01")
+            create_practice(code="02")
+            create_measures()
+            response = self.client.get(
+                reverse("measure", kwargs={"measure": "testmeasure"})
+            )
+            # Both charts are identical, so they and their derivatives have
+            # the same URLs
+            srcset = "{} 216w, {} 324w, {} 432w".format(
+                chart_file_src("testmeasure_01_02.216w.png"),
+                chart_file_src("testmeasure_01_02.324w.png"),
+                chart_file_src("testmeasure_01_02.png"),
+            )
+            webp = self.client.get(chart_file_src("testmeasure_01_02.216w.webp"))
+        html = lxml.html.document_fromstring(response.content)
+        self.assertEqual(
+            html.xpath("//img[contains(@class, 'measure-chart')]/@srcset"),
+            [srcset, srcset],
+        )
+        self.assertNotIn("/static/", srcset)
+        self.assertEqual(webp.status_code, 200)
+        self.assertEqual(webp["Content-Type"], "image/webp")
+
+    def test_optimise_renamed_chart(self):
+        self.optimise()
+        os.rename(
+            os.path.join(self.tmp.name, "testmeasure_01_02.png"),
+            os.path.join(self.tmp.name, "testmeasure_01_03.png"),
+        )
+        output = self.optimise()
+        self.assertIn("Optimised 0 charts (1 unchanged, 1 renamed)", output)
+        self.assertIn("removed 5 orphaned derivatives", output)
+        filenames = os.listdir(self.tmp.name)
+        self.assertIn("testmeasure_01_03.216w.webp", filenames)
+        self.assertFalse([x for x in filenames if x.startswith("testmeasure_01_02")])
+
+    def test_build_chart_atlases(self):
+        out = StringIO()
+        with override_settings(PREGENERATED_CHARTS_ROOT=self.tmp.name):
+            call_command(
+                "build_chart_atlases", "--workers", "1", "--columns", "1", stdout=out
+            )
+        self.assertIn("Built 1 atlases for 1 measures (0 unchanged)", out.getvalue())
+        atlas_dir = os.path.join(self.tmp.name, "atlases")
+        with open(os.path.join(atlas_dir, "testmeasure.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(len(manifest["atlases"]), 1)
+        with Image.open(os.path.join(self.tmp.name, manifest["atlases"][0])) as atlas:
+            self.assertEqual(atlas.size, (432, 576))
+
+        out = StringIO()
+        with override_settings(PREGENERATED_CHARTS_ROOT=self.tmp.name):
+            call_command(
+                "build_chart_atlases", "--workers", "1", "--columns", "1", stdout=out
+            )
+        self.assertIn("Built 0 atlases for 0 measures (1 unchanged)", out.getvalue())
+
+        with override_settings(
+            PREGENERATED_CHARTS_ROOT=self.tmp.name,
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+        ):
+            create_practice(code="01")
+            create_practice(code="02")
+            create_measures()
+            response = self.client.get(
+                reverse("measure", kwargs={"measure": "testmeasure"})
+            )
+            atlas_src = chart_file_src(manifest["atlases"][0])
+            atlas = self.client.get(atlas_src)
+        html = lxml.html.document_fromstring(response.content)
+        styles = html.xpath("//span[contains(@class, 'chart-tile')]/@style")
+        self.assertEqual(len(styles), 2)
+        self.assertIn(atlas_src, styles[0])
+        self.assertEqual(atlas.status_code, 200)
+        self.assertEqual(atlas["Content-Type"], "image/png")
+        self.assertIn("background-position: -0px -0px", styles[0])
+        self.assertIn("background-position: -0px -288px", styles[1])
+
+        # Filtered or re-sorted pages don't line up with the atlases
+        with override_settings(
+            PREGENERATED_CHARTS_ROOT=self.tmp.name,
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+        ):
+            for query in ("filter=ods/01", "sort=-rank"):
+                response = self.client.get(
+                    reverse("measure", kwargs={"measure": "testmeasure"}) + "?" + query
+                )
+                self.assertNotContains(response, "measure-chart chart-tile")
+                self.assertContains(response, 'loading="lazy"')
+
+    def test_build_chart_atlases_off_page_boundaries(self):
+        with override_settings(PREGENERATED_CHARTS_ROOT=self.tmp.name):
+            with self.assertRaises(CommandError):
+                call_command(
+                    "build_chart_atlases", "--workers", "1", "--tiles-per-atlas", "7"
+                )
+
+
+@override_settings(
+    PREGENERATED_CHARTS_ROOT="/tmp/test_charts/",
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+)
+class ApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_json(self, url, **extra):
+        response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b"".join(response.streaming_content)), response
+
+    def test_measures(self):
+        with create_measure_with_practices():
+            data, _ = self.get_json(reverse("api_measures"))
+            self.assertEqual(data["count"], 2)
+            self.assertEqual(
+                [x["id"] for x in data["results"]], ["has_no_data", "testmeasure"]
+            )
+
+    def test_groups(self):
+        with create_measure_with_practices():
+            data, _ = self.get_json(reverse("api_groups"))
+            self.assertEqual(
+                data["results"],
+                [
+                    {
+                        "code": "ods/RG5",
+                        "name": "My CCG",
+                        "kind": "ccg",
+                        "practice_count": 2,
+                    }
+                ],
+            )
+
+    def test_measure_charts(self):
+        with create_measure_with_practices() as measure:
+            url = reverse("api_measure_charts", kwargs={"measure": measure.id})
+            data, response = self.get_json(url)
+            self.assertEqual(
+                [x["url"] for x in data["results"]],
+                [
+                    chart_src("testmeasure_02_01.png"),
+                    chart_src("testmeasure_01_02.png"),
+                ],
+            )
+            self.assertEqual(
+                data["results"][0],
+                {
+                    "measure_id": "testmeasure",
+                    "practice_code": "ods/02",
+                    "rank": 1,
+                    "url": chart_src("testmeasure_02_01.png"),
+                },
+            )
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(not_modified.status_code, 304)
+
+            data, _ = self.get_json(url + "?filter=ods/01")
+            self.assertEqual(data["count"], 1)
+
+            data, _ = self.get_json(url + "?sort=-rank")
+            self.assertEqual(data["results"][0]["practice_code"], "ods/01")
+            self.assertEqual(self.client.get(url + "?sort=x").status_code, 400)
+
+            data, _ = self.get_json(url + "?page=1&page_size=1")
+            self.assertEqual(data["count"], 2)
+            self.assertEqual(len(data["results"]), 1)
+            self.assertTrue(data["next"].endswith("?page=2&page_size=1"))
+            data, _ = self.get_json(data["next"])
+            self.assertEqual(data["results"][0]["practice_code"], "ods/01")
+            self.assertIsNone(data["next"])
+
+    def test_practice_charts(self):
+        with create_measure_with_practices():
+            data, _ = self.get_json(
+                reverse("api_practice_charts", kwargs={"practice": "ods/01"})
+            )
+            self.assertEqual(
+                [x["url"] for x in data["results"]],
+                [chart_src("testmeasure_01_02.png")],
+            )
+            response = self.client.get(
+                reverse("api_practice_charts", kwargs={"practice": "ods/RG5"})
+            )
+            self.assertEqual(response.status_code, 404)
+
+    def test_search(self):
+        with create_measure_with_practices() as measure:
+            url = reverse("api_search")
+            response = self.client.get(url, {"q": "my pr"})
+            self.assertEqual(
+                [x["code"] for x in response.json()["results"]], ["ods/01", "ods/02"]
+            )
+            response = self.client.get(url, {"q": "ods/02"})
+            self.assertEqual(
+                response.json()["results"],
+                [
+                    {
+                        "name": Practice.objects.get(name="My practice 02").cased_name,
+                        "kind": "practice",
+                        "code": "ods/02",
+                        "url": reverse("practice", kwargs={"practice": "ods/02"}),
+                    }
+                ],
+            )
+            response = self.client.get(url, {"q": "rg5"})
+            self.assertEqual(response.json()["results"][0]["url"], None)
+            response = self.client.get(url, {"q": "ccg", "measure": measure.id})
+            self.assertEqual(
+                response.json()["results"][0]["url"],
+                reverse("measure", kwargs={"measure": measure.id})
+                + "?filter=ods%2FRG5",
+            )
+            create_practice(code="03")
+            response = self.client.get(url, {"q": "pract", "limit": 1})
+            self.assertEqual(len(response.json()["results"]), 1)
+            for limit in (0, -1):
+                response = self.client.get(url, {"q": "pract", "limit": limit})
+                self.assertEqual(len(response.json()["results"]), 1)
+            self.assertEqual(self.client.get(url, {"q": ""}).json(), {"results": []})
+            self.assertEqual(
+                self.client.get(url, {"q": "x", "limit": "x"}).status_code, 400
+            )
+
+    def test_search_ranking(self):
+        index = SearchIndex(
+            [
+                (SearchResult(name, "practice", code), [name], [code])
+                for name, code in [
+                    ("Beech Surgery", "B1"),
+                    ("Ash Surgery", "A1"),
+                    ("Surgery at the Station", "S1"),
+                    ("Surrey Heath", "SUR"),
+                    ("Surgery on the Green", "S2"),
+                ]
+            ]
+        )
+        self.assertEqual(
+            [x.code for x in index.search("sur", 10)], ["SUR", "S1", "S2", "A1", "B1"],
+        )
+        self.assertEqual([x.code for x in index.search("surg ash", 10)], ["A1"])
+        self.assertEqual([x.code for x in index.search("sur", 2)], ["SUR", "S1"])
+        self.assertEqual([x.code for x in index.search("surgery on", 10)], ["S2"])
+        self.assertEqual([x.code for x in index.search("surgery t", 10)], ["S1", "S2"])
+
+
+MEASURE_VALUES_CSV = """practice_ods_code,month,numerator,denominator
+01,2019-01-01,1,10
+01,2019-02-01,2,10
+02,2019-02-01,3,,
+"""
+
+
+class MeasureValuesTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def import_values(self, content):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write(content)
+            f.flush()
+            call_command(
+                "import_measure_values",
+                "--filename",
+                f.name,
+                "--measure",
+                "testmeasure",
+                stdout=StringIO(),
+            )
+
+    def test_import_measure_values(self):
+        measure = create_measures()
+        with override_settings(MEASURE_VALUES_ROOT=self.tmp.name):
+            self.assertIsNone(measure.values())
+            self.import_values(MEASURE_VALUES_CSV)
+            values = measure.values()
+            self.assertEqual(values.practices, ["01", "02"])
+            self.assertEqual(values.months, ["2019-01-01", "2019-02-01"])
+            practice = values.for_practice("01")
+            self.assertEqual(practice.tolist(), [[1, 2], [10, 10]])
+            self.assertTrue(np.shares_memory(practice, values.values))
+            self.assertIsNone(values.for_practice("03"))
+            month = values.for_month("2019-02-01")
+            self.assertEqual(month[0].tolist(), [2, 3])
+            self.assertTrue(np.isnan(month[1][1]))
+            self.assertTrue(np.isnan(values.numerators[1][0]))
+
+            self.import_values(
+                MEASURE_VALUES_CSV.replace("01,2019-01-01,1", "01,2019-01-01,5")
+            )
+            self.assertEqual(measure.values().for_practice("01")[0].tolist(), [5, 2])
+            self.assertEqual(
+                len([x for x in os.listdir(self.tmp.name) if x.endswith(".npy")]), 1
+            )
+
+    def test_import_unchanged_measure_values(self):
+        create_measures()
+        with override_settings(MEASURE_VALUES_ROOT=self.tmp.name):
+            self.import_values(MEASURE_VALUES_CSV)
+            version = DataVersion.current()
+            index_path = os.path.join(self.tmp.name, "testmeasure.json")
+            mtime = os.stat(index_path).st_mtime_ns
+            self.import_values(MEASURE_VALUES_CSV)
+            self.assertEqual(DataVersion.current(), version)
+            self.assertEqual(os.stat(index_path).st_mtime_ns, mtime)
+
+    def test_write_keeps_referenced_values_files(self):
+        values = {("01", "2019-01-01"): (1, 10)}
+        write_measure_values(self.tmp.name, "a", values)
+        self.assertTrue(write_measure_values(self.tmp.name, "b", values))
+        self.assertFalse(write_measure_values(self.tmp.name, "b", values))
+        write_measure_values(self.tmp.name, "b", {("01", "2019-01-01"): (2, 10)})
+        self.assertIsNotNone(MeasureValues.load(self.tmp.name, "a"))
+        files = os.listdir(self.tmp.name)
+        self.assertEqual(len([x for x in files if x.endswith(".npy")]), 2)
+        self.assertEqual(
+            sorted(x for x in files if x.endswith(".json")), ["a.json", "b.json"]
+        )
+        self.assertFalse([x for x in files if x.endswith(".tmp")])
+
+
+class BenchmarkTests(TestCase):
+    def test_run_benchmarks(self):
+        results = run_benchmarks(practices=3, groups=2, measures=2, repeat=1)
+        self.assertEqual(results["params"]["practices"], 3)
+        self.assertEqual(results["results"]["views.measure"]["queries"], 4)
+        self.assertIn("import_practices --bulk", results["results"])
+        self.assertEqual(compare_results(results, results, tolerance=1.5), [])
+
+    def test_compare_results(self):
+        params = {"practices": 1, "groups": 1, "measures": 1, "repeat": 1}
+        baseline = {
+            "params": params,
+            "results": {"views.measure": {"median": 0.01, "queries": 4}},
+        }
+        slower = {
+            "params": params,
+            "results": {"views.measure": {"median": 0.05, "queries": 5}},
+        }
+        self.assertEqual(
+            compare_results(baseline, slower, tolerance=1.5),
+            [
+                "views.measure: median 0.0500s, was 0.0100s",
+                "views.measure: 5 queries, was 4",
+            ],
+        )
+        with self.assertRaises(CommandError):
+            compare_results(baseline, dict(slower, params={}), tolerance=1.5)
+
+
+class IncrementalStaticFilesStorageTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "source")
+        self.static_root = os.path.join(self.tmp.name, "static")
+        os.makedirs(self.source)
+        Image.new("RGBA", (10, 10), "white").save(
+            os.path.join(self.source, "testmeasure_01_02.png")
+        )
+        with open(os.path.join(self.source, "app.js"), "w") as f:
+            f.write("console.log('hello');\n" * 100)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def collectstatic(self):
+        with override_settings(
+            STATICFILES_STORAGE=(
+                "frontend.storage.IncrementalCompressedManifestStaticFilesStorage"
+            ),
+            STATICFILES_DIRS=[self.source],
+            STATIC_ROOT=self.static_root,
+            INSTALLED_APPS=["django.contrib.staticfiles"],
+        ):
+            call_command("collectstatic", "--noinput", verbosity=0)
+        with open(os.path.join(self.static_root, "staticfiles.json")) as f:
+            return json.load(f)["paths"]
+
+    def test_unchanged_files_not_rehashed_or_recompressed(self):
+        paths = self.collectstatic()
+        compressed = os.path.join(self.static_root, paths["app.js"] + ".gz")
+        self.assertTrue(os.path.exists(compressed))
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(self.static_root, paths["testmeasure_01_02.png"] + ".gz")
+            )
+        )
+        compressed_mtime = os.stat(compressed).st_mtime_ns
+
+        with patch.object(
+            ManifestStaticFilesStorage, "file_hash", side_effect=AssertionError
+        ):
+            self.assertEqual(self.collectstatic(), paths)
+        self.assertEqual(os.stat(compressed).st_mtime_ns, compressed_mtime)
+
+        Image.new("RGBA", (10, 10), "black").save(
+            os.path.join(self.source, "testmeasure_01_02.png")
+        )
+        new_paths = self.collectstatic()
+        self.assertNotEqual(
+            new_paths["testmeasure_01_02.png"], paths["testmeasure_01_02.png"]
+        )
+        self.assertEqual(new_paths["app.js"], paths["app.js"])
+
+
+@override_settings(
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+)
+class AsgiTests(SimpleTestCase):
+    def request(self, application, path, query_string=b""):
+        """Make a GET request through an ASGI application, returning the
+        messages it sent
+        """
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "GET",
+            "path": path,
+            "query_string": query_string,
+            "headers": [(b"host", b"testserver")],
+        }
+        asyncio.run(application(scope, receive, send))
+        return sent
+
+    def test_asgi_application(self):
+        finished = Mock()
+        request_finished.connect(finished)
+        try:
+            sent = self.request(asgi.application, reverse("about"), b"a=1")
+        finally:
+            request_finished.disconnect(finished)
+        self.assertEqual(sent[0]["type"], "http.response.start")
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn(
+            (b"content-type", b"text/html; charset=utf-8"), sent[0]["headers"]
+        )
+        body = b"".join(message.get("body", b"") for message in sent[1:])
+        self.assertIn(b"<html", body)
+        self.assertFalse(sent[-1].get("more_body", False))
+        # The response is closed, so Django tidies up after the request
+        finished.assert_called_once()
+
+    def test_requests_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wsgi_application(environ, start_response):
+            # Only returns once both requests are running at once
+            barrier.wait()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [threading.current_thread().name.encode("utf-8")]
+
+        application = asgi.ThreadPoolWsgiToAsgi(wsgi_application, threads=2)
+
+        async def requests():
+            return await asyncio.gather(
+                *(
+                    asyncio.get_running_loop().run_in_executor(
+                        None, self.request, application, "/"
+                    )
+                    for _ in range(2)
+                )
+            )
+
+        results = asyncio.run(requests())
+        thread_names = {sent[1]["body"] for sent in results}
+        self.assertEqual(len(thread_names), 2)
+
+
+class SnapshotTests(TestCase):
+    def test_export_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot.sqlite3")
+            with create_measure_with_practices():
+                out = StringIO()
+                call_command("export_snapshot", "--output", path, stdout=out)
+            self.assertIn("frontend_practice: 2", out.getvalue())
+            self.assertIn("frontend_practice_groups: 2", out.getvalue())
+            db = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+            try:
+                self.assertEqual(
+                    db.execute(
+                        "SELECT code FROM frontend_coding ORDER BY code"
+                    ).fetchall(),
+                    [("01",), ("02",), ("RG5",)],
+                )
+                indexes = db.execute(
+                    "SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = 'frontend_coding'"
+                ).fetchall()
+                self.assertGreater(len(indexes), 0)
+                with self.assertRaises(sqlite3.OperationalError):
+                    db.execute("DELETE FROM frontend_measure")
+            finally:
+                db.close()
+
+    def test_router(self):
+        router = SnapshotRouter()
+        self.assertIsNone(router.db_for_read(Practice))
+        with reading_from_snapshot():
+            self.assertEqual(router.db_for_read(Practice), "snapshot")
+            self.assertEqual(router.db_for_read(ContentType), "snapshot")
+            self.assertIsNone(router.db_for_read(User))
+            self.assertEqual(router.db_for_write(Practice), "default")
+        self.assertIsNone(router.db_for_read(Practice))
+        self.assertFalse(router.allow_migrate("snapshot", "frontend"))
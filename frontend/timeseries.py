@@ -0,0 +1,169 @@
+"""A compact, memory-mapped store of the monthly values behind each measure.
+
+Each measure's numerators and denominators are held in one NumPy array of
+shape (2, practices, months), saved as a `.npy` file under
+`MEASURE_VALUES_ROOT` and memory-mapped when read. Missing values are NaN.
+A small JSON index alongside it labels the rows with practice ODS codes
+and the columns with months, and names the current `.npy` file, so
+replacing a measure's values is a single atomic rename of the index.
+
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+
+NUMERATOR = 0
+DENOMINATOR = 1
+
+
+def _index_path(root, measure_id):
+    return os.path.join(root, "{}.json".format(measure_id))
+
+
+class MeasureValues:
+    """Numerators and denominators for one measure, by practice and month
+    """
+
+    def __init__(self, practices, months, values):
+        self.practices = practices
+        self.months = months
+        self.values = values
+        self.practice_rows = {code: row for row, code in enumerate(practices)}
+        self.month_columns = {month: column for column, month in enumerate(months)}
+
+    @classmethod
+    def load(cls, root, measure_id):
+        """Return the values stored for `measure_id`, memory-mapped, or None if
+        there are none
+
+        """
+        try:
+            with open(_index_path(root, measure_id)) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return None
+        values = np.load(os.path.join(root, index["values_file"]), mmap_mode="r")
+        return cls(index["practices"], index["months"], values)
+
+    @property
+    def numerators(self):
+        return self.values[NUMERATOR]
+
+    @property
+    def denominators(self):
+        return self.values[DENOMINATOR]
+
+    def for_practice(self, ods_code):
+        """Return a (2, months) view of one practice's numerators and
+        denominators, or None if the practice has no values
+
+        """
+        row = self.practice_rows.get(ods_code)
+        if row is None:
+            return None
+        return self.values[:, row, :]
+
+    def for_month(self, month):
+        """Return a (2, practices) view of every practice's numerators and
+        denominators for one month (an ISO date string)
+
+        """
+        return self.values[:, :, self.month_columns[month]]
+
+
+def _load_index(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _referenced_values_files(root):
+    """Return the names of the `.npy` files named by any index in `root`
+    """
+    referenced = set()
+    for name in os.listdir(root):
+        if name.endswith(".json"):
+            index = _load_index(os.path.join(root, name))
+            if index is not None:
+                referenced.add(index["values_file"])
+    return referenced
+
+
+def write_measure_values(root, measure_id, values_by_practice_and_month):
+    """Replace the stored values for `measure_id`.
+
+    `values_by_practice_and_month` maps (ods_code, month) tuples to
+    (numerator, denominator) tuples.
+
+    Returns whether anything changed.
+
+    """
+    practices = sorted({practice for practice, _ in values_by_practice_and_month})
+    months = sorted({month for _, month in values_by_practice_and_month})
+    rows = {code: row for row, code in enumerate(practices)}
+    columns = {month: column for column, month in enumerate(months)}
+    values = np.full((2, len(practices), len(months)), np.nan)
+    for (practice, month), pair in values_by_practice_and_month.items():
+        values[:, rows[practice], columns[month]] = pair
+
+    os.makedirs(root, exist_ok=True)
+    index_path = _index_path(root, measure_id)
+    values_file = "{}.{}.npy".format(
+        measure_id, hashlib.md5(values.tobytes()).hexdigest()[:12]
+    )
+    index = {"practices": practices, "months": months, "values_file": values_file}
+    previous_index = _load_index(index_path)
+    if previous_index == index:
+        return False
+
+    # The file is named by its content, so if it exists it's already right
+    values_path = os.path.join(root, values_file)
+    if not os.path.exists(values_path):
+        tmp_path = values_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp_path, values_path)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    # Readers that already have the old file mapped keep their mapping
+    if previous_index is not None:
+        previous_values_file = previous_index["values_file"]
+        if previous_values_file not in _referenced_values_files(root):
+            try:
+                os.remove(os.path.join(root, previous_values_file))
+            except FileNotFoundError:
+                pass
+    return True
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def get_measure_values(measure_id):
+    """Return the MeasureValues for `measure_id` from `MEASURE_VALUES_ROOT`,
+    loading them once per process and again whenever they are replaced
+
+    """
+    root = settings.MEASURE_VALUES_ROOT
+    try:
+        mtime = os.stat(_index_path(root, measure_id)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    key = (root, measure_id)
+    loaded = _loaded.get(key)
+    if loaded is None or loaded[0] != mtime:
+        with _loaded_lock:
+            loaded = (mtime, MeasureValues.load(root, measure_id))
+            _loaded[key] = loaded
+    return loaded[1]
@@ -1,28 +1,234 @@
+import functools
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.http import FileResponse
+from django.http import Http404
+from django.http import QueryDict
 from django.shortcuts import render
+from django.urls import reverse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.db.models import Count
 from django.views.generic import TemplateView
 
+from frontend.charts import DEFAULT_SORT
+from frontend.charts import get_chart_index
+from frontend.models import DataVersion
 from frontend.models import Group
 from frontend.models import Measure
 from frontend.models import Practice
-from frontend.models import chart_urls
 
 
-def _get_filtered_practices(request):
-    code_filter = request.GET.get("filter", None)
-    if code_filter:
-        return Practice.objects.filter_by_entity_code(code_filter)
-    else:
-        practices = Practice.objects.all()
-    return practices
+def cache_for_data_version(query_params=("filter",)):
+    """Cache a view's responses until the data version changes or charts are
+    added or removed.
+
+    Responses are keyed on the request path and the values of
+    `query_params`; any other query parameters are ignored.
+
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+            variant = [request.path]
+            for param in query_params:
+                for value in request.GET.getlist(param):
+                    variant.append("{}={}".format(param, value))
+            key = "view:{}:{}:{}:{}".format(
+                view.__name__,
+                DataVersion.current(),
+                get_chart_index().signature,
+                hashlib.md5("\0".join(variant).encode("utf-8")).hexdigest(),
+            )
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    cache.set(key, response, timeout=None)
+            return response
+
+        return wrapped
+
+    return decorator
+
+
+CHART_CONTENT_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+# The query parameters that choose which charts a measure page shows
+CHART_PAGE_QUERY_PARAMS = ("filter", "page", "sort")
+
+
+def chart_file_src(filename):
+    """Return the URL of a chart, or one of its derivatives or atlases, given
+    its filename in the chart directory. It's derived from the file's
+    content, so files added since `collectstatic` last ran can be served.
+    """
+    return reverse(
+        "chart",
+        kwargs={
+            "content_hash": get_chart_index().file_hash(filename),
+            "extension": filename.rpartition(".")[2],
+        },
+    )
+
+
+def chart_src(chart):
+    """Return the URL of a chart's image, derived from its content
+    """
+    return chart_file_src(chart.url)
+
 
+def _srcset(sources):
+    return ", ".join(
+        "{} {}w".format(chart_file_src(url), width) for url, width in sources
+    )
 
+
+def _chart_context(chart, use_atlas=False, **kwargs):
+    """Return the template context for showing one chart, including
+    responsive image sources if it has been optimised, and (if `use_atlas`)
+    its tile in the measure's atlas if one has been built
+
+    """
+    index = get_chart_index()
+    context = {
+        "url": chart.url,
+        "src": chart_src(chart),
+        "srcset": None,
+        "webp_srcset": None,
+        "tile": None,
+    }
+    srcsets = index.srcsets(chart)
+    if srcsets:
+        context["srcset"] = _srcset(srcsets["png"])
+        context["webp_srcset"] = _srcset(srcsets["webp"])
+    if use_atlas:
+        tile = index.atlas_tile(chart)
+        if tile:
+            context["tile"] = dict(tile, url=chart_file_src(tile["url"]))
+    context.update(kwargs)
+    return context
+
+
+def _get_filtered_practice_codes(request):
+    """Return the ODS codes of practices matching every `filter` in the
+    query string, or of all practices if there are none
+
+    """
+    code_filters = request.GET.getlist("filter")
+    return Practice.objects.membership().practice_codes(code_filters)
+
+
+def _sort_order(request):
+    """Return the chart sort order given by the `sort` query parameter, or
+    the default if it's missing or not one the chart index offers
+
+    """
+    sort = request.GET.get("sort")
+    if sort in get_chart_index().sort_orders:
+        return sort
+    return DEFAULT_SORT
+
+
+def _chart_page_query(request):
+    """Return a mutable copy of the query parameters that choose a page of
+    charts, leaving out any others: pages are cached on these alone (see
+    `cache_for_data_version`), so links in them mustn't depend on any others
+    """
+    query = QueryDict(mutable=True)
+    for param in CHART_PAGE_QUERY_PARAMS:
+        if param in request.GET:
+            query.setlist(param, request.GET.getlist(param))
+    return query
+
+
+def _sort_links(request):
+    """Return a link to the current page in each of the chart index's sort
+    orders, or none if charts can only be sorted by rank
+
+    """
+    sort_orders = get_chart_index().sort_orders
+    if sort_orders == [DEFAULT_SORT, "-" + DEFAULT_SORT]:
+        return []
+    current = _sort_order(request)
+    query = _chart_page_query(request)
+    query.pop("page", None)
+    links = []
+    for sort_order in sort_orders:
+        query["sort"] = sort_order
+        label = sort_order.lstrip("-").replace("_", " ").capitalize()
+        if sort_order.startswith("-"):
+            label += " (descending)"
+        links.append(
+            {
+                "label": label,
+                "url": "?" + query.urlencode(),
+                "active": sort_order == current,
+            }
+        )
+    return links
+
+
+@cache_for_data_version()
 def measures(request):
     measures = Measure.objects.all()
     context = {"measures": measures}
     return render(request, "measures.html", context)
 
 
+def _measure_charts_page(request, measure):
+    """Return template context for the page of a measure's charts given by
+    the `page` query parameter
+
+    """
+    ods_codes_for_practices = _get_filtered_practice_codes(request)
+    charts = measure.charts(
+        ods_practice_codes=ods_codes_for_practices, sort=_sort_order(request)
+    )
+    page = Paginator(charts, settings.CHARTS_PER_PAGE).get_page(request.GET.get("page"))
+    # Atlases hold a page's worth of charts each, in rank order, so they
+    # only line up with the pages of an unfiltered list in that order
+    use_atlas = (
+        not request.GET.getlist("filter")
+        and _sort_order(request) == DEFAULT_SORT
+        and len(charts) == len(get_chart_index().for_measure(measure.id))
+    )
+    urls_and_codes = [
+        _chart_context(
+            chart,
+            use_atlas=use_atlas,
+            measure_id=None,
+            practice_code="ods/{}".format(chart.practice_code),
+        )
+        for chart in page.object_list
+    ]
+    next_page_url = next_fragment_url = None
+    if page.has_next():
+        query = _chart_page_query(request)
+        query["page"] = page.next_page_number()
+        next_page_url = "{}?{}".format(
+            reverse("measure", kwargs={"measure": measure.id}), query.urlencode()
+        )
+        next_fragment_url = "{}?{}".format(
+            reverse("measure_charts", kwargs={"measure": measure.id}),
+            query.urlencode(),
+        )
+    return {
+        "urls_and_codes": urls_and_codes,
+        "page": page,
+        "next_page_url": next_page_url,
+        "next_fragment_url": next_fragment_url,
+    }
+
+
+@cache_for_data_version(query_params=CHART_PAGE_QUERY_PARAMS)
 def measure(request, measure):
     # Initially this allows us to show all practices for one measure.
     # Longer term, it would be good to support:
@@ -34,33 +240,38 @@ def measure(request, measure):
     #  * /liver_tests/?filter=ods/08H&group_by=practice
     #  * /liver_tests/?filter&group_by=lab
     measure = Measure.objects.get(pk=measure)
-    practices = _get_filtered_practices(request)
-    ods_codes_for_practices = [
-        practice.codes.get(system="ods").code for practice in practices
-    ]
-    groups = Group.objects.annotate(Count("practice")).filter(practice__count__gt=0)
-    for g in groups:
-        g.active = str(g.codes.first()) == request.GET.get("filter", None)
-    urls = measure.chart_urls(ods_practice_codes=ods_codes_for_practices)
-    codes = [x.split("_")[1] for x in urls]
-    urls_and_codes = [
-        {"measure_id": None, "practice_code": "ods/{}".format(x[0]), "url": x[1]}
-        for x in zip(codes, urls)
-    ]
-    context = {"urls_and_codes": urls_and_codes, "measure": measure, "groups": groups}
+    groups = Group.objects.navigation()
+    context = {
+        "measure": measure,
+        "groups": groups,
+        "filters": request.GET.getlist("filter"),
+        "sort_links": _sort_links(request),
+    }
+    context.update(_measure_charts_page(request, measure))
     return render(request, "measure.html", context)
 
 
+@cache_for_data_version(query_params=CHART_PAGE_QUERY_PARAMS)
+def measure_charts(request, measure):
+    """Return the HTML for one page of a measure's charts, for appending to
+    the measure page as the user scrolls
+
+    """
+    measure = Measure.objects.get(pk=measure)
+    context = _measure_charts_page(request, measure)
+    return render(request, "_measure_charts.html", context)
+
+
+@cache_for_data_version()
 def practice(request, practice):
     """Show all measures by practice
     """
     practice = Practice.objects.get_by_entity_code(practice)
     groups = Group.objects.annotate(Count("practice")).filter(practice=practice)
-    urls = chart_urls(ods_practice_codes=[practice.ods_code().code])
-    measures = [x.split("_")[0] for x in urls]
+    charts = get_chart_index().for_practices([practice.ods_code()])
     urls_and_codes = [
-        {"measure_id": x[0], "practice_code": None, "url": x[1]}
-        for x in zip(measures, urls)
+        _chart_context(chart, measure_id=chart.measure_id, practice_code=None)
+        for chart in charts
     ]
     context = {
         "urls_and_codes": urls_and_codes,
@@ -71,6 +282,41 @@ def practice(request, practice):
     return render(request, "measure.html", context)
 
 
+def _chart_file(content_hash, extension):
+    if extension not in CHART_CONTENT_TYPES:
+        return None
+    filename = get_chart_index().file_for_content_hash(content_hash)
+    if filename is None or not filename.endswith("." + extension):
+        return None
+    return filename
+
+
+def _chart_etag(request, content_hash, extension):
+    if _chart_file(content_hash, extension) is None:
+        return None
+    return content_hash
+
+
+# Chart URLs change whenever their content does, so they can be cached forever
+@cache_control(public=True, max_age=31536000, immutable=True)
+@condition(etag_func=_chart_etag)
+def chart(request, content_hash, extension):
+    """Serve a chart's image, or one of its derivatives or atlases, by the
+    hash of its content
+    """
+    filename = _chart_file(content_hash, extension)
+    if filename is None:
+        raise Http404("No chart with hash {}".format(content_hash))
+    index = get_chart_index()
+    f = open(os.path.join(index.root, filename), "rb")
+    # The file may have been replaced since it was hashed, and its new
+    # content mustn't be cached under the old hash
+    if not index.is_unchanged(filename, f):
+        f.close()
+        raise Http404("Chart with hash {} has changed".format(content_hash))
+    return FileResponse(f, content_type=CHART_CONTENT_TYPES[extension])
+
+
 class DynamicTemplateView(TemplateView):
     def get_template_names(self):
         return ["blog/%s.html" % self.kwargs["template"]]
@@ -0,0 +1,82 @@
+"""
+ASGI config for openpath project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+for serving with an ASGI server, e.g.:
+
+    gunicorn openpath.asgi:application -k uvicorn.workers.UvicornWorker
+
+Django 2.2 can only run views synchronously, so requests are handed to the
+WSGI application by asgiref's `WsgiToAsgi`. The event loop stays free to
+accept connections and stream responses while views wait on the database or
+filesystem, so one process serves many page loads at once.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+from asgiref.wsgi import WsgiToAsgiInstance
+from django.core.wsgi import get_wsgi_application
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """asgiref's `WsgiToAsgi`, running requests on a pool of `threads`
+    threads. By default asgiref runs every request on the same thread, one
+    at a time.
+    """
+
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="asgi"
+        )
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiToAsgiInstance(self.wsgi_application, self.executor)(
+            scope, receive, send
+        )
+
+
+class ThreadPoolWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """Runs one request on `executor`, using asgiref's `build_environ`,
+    `start_response` and `sync_send`. Unlike asgiref's own `run_wsgi_app`, it
+    closes the response afterwards, which is when Django sends
+    `request_finished` and closes database connections that have expired.
+    """
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(
+            self.run_wsgi_app_in_thread, thread_sensitive=False, executor=self.executor
+        )(body)
+
+    def run_wsgi_app_in_thread(self, body):
+        environ = self.build_environ(self.scope, body)
+        chunks = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in chunks:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            if not self.response_started:
+                self.response_started = True
+                self.sync_send(self.response_start)
+            self.sync_send({"type": "http.response.body"})
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "openpath.settings")
+
+application = ThreadPoolWsgiToAsgi(
+    get_wsgi_application(), threads=int(os.environ.get("ASGI_THREADS", 32))
+)
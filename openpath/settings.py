@@ -46,6 +46,10 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    # Before anything that touches the database or the session
+    "frontend.prerender.PrerenderedPagesMiddleware",  # Only if PRERENDERED_PAGES_ROOT is set
+    "frontend.instrumentation.ServerTimingMiddleware",  # Only if SERVER_TIMING is set
+    "frontend.snapshot.SnapshotDatabaseMiddleware",  # Only if SNAPSHOT_DATABASE exists
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.cache.UpdateCacheMiddleware",  # Sets expires header to CACHE_MIDDLEWARE_SECONDS
     "django.middleware.common.CommonMiddleware",
@@ -60,7 +64,8 @@ ROOT_URLCONF = "openpath.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # DjangoTemplates, timing rendering for ServerTimingMiddleware
+        "BACKEND": "frontend.instrumentation.TimedDjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -83,6 +88,18 @@ WSGI_APPLICATION = "openpath.wsgi.application"
 # Uses the DATABASE_URL environment variable per Heroku / 12factor spec
 DATABASES = {"default": dj_database_url.config(conn_max_age=600, ssl_require=True)}
 
+# A read-only SQLite copy of the frontend tables, written by
+# `./manage.py export_snapshot`, to serve pages from instead of the primary
+# database (see frontend/snapshot.py)
+SNAPSHOT_DATABASE = os.environ.get("SNAPSHOT_DATABASE")
+if SNAPSHOT_DATABASE and os.path.exists(SNAPSHOT_DATABASE):
+    DATABASES["snapshot"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": "file:{}?mode=ro".format(SNAPSHOT_DATABASE),
+        "OPTIONS": {"uri": True},
+    }
+    DATABASE_ROUTERS = ["frontend.snapshot.SnapshotRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -118,7 +135,9 @@ STATIC_URL = "/static/"
 STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
 
-STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+# WhiteNoise's CompressedManifestStaticFilesStorage, but only hashing and
+# compressing files that have changed since the last collectstatic
+STATICFILES_STORAGE = "frontend.storage.IncrementalCompressedManifestStaticFilesStorage"
 
 ## Logging
 
@@ -145,10 +164,50 @@ LOGGING = {
             "formatter": "verbose",
         },
     },
-    "loggers": {"testlogger": {"handlers": ["console"], "level": "INFO"}},
+    "loggers": {
+        "testlogger": {"handlers": ["console"], "level": "INFO"},
+        "frontend.instrumentation": {"handlers": ["console"], "level": "INFO"},
+    },
 }
 
 
 CACHE_MIDDLEWARE_SECONDS = 0
+
+# Pages and lookups derived from imported data are cached against
+# `frontend.models.DataVersion`, so entries never need to expire. Set
+# CACHE_DIR to share the cache between worker processes on one host.
+CACHE_DIR = os.environ.get("CACHE_DIR")
+if CACHE_DIR:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": CACHE_DIR,
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
 PREGENERATED_CHARTS_ROOT = os.path.join(BASE_DIR, "charts")
 STATICFILES_DIRS = [PREGENERATED_CHARTS_ROOT]
+CHARTS_PER_PAGE = 30
+# How often, in seconds, to check the chart directory for new charts
+CHART_RELOAD_INTERVAL = float(os.environ.get("CHART_RELOAD_INTERVAL", 2))
+
+# Monthly numerators and denominators per measure, as imported by
+# `./manage.py import_measure_values`
+MEASURE_VALUES_ROOT = os.path.join(BASE_DIR, "measure_values")
+
+# Where `./manage.py prerender_pages` writes HTML for measure and practice
+# pages; when set, those files are served in preference to the views
+PRERENDERED_PAGES_ROOT = os.environ.get("PRERENDERED_PAGES_ROOT")
+
+# Report SQL, chart lookup and template times for every request in a
+# Server-Timing header and a log line, and log the slowest queries of
+# requests that take longer than SLOW_REQUEST_MS
+SERVER_TIMING = bool(os.environ.get("SERVER_TIMING"))
+SLOW_REQUEST_MS = int(os.environ.get("SLOW_REQUEST_MS", 1000))
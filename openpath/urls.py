@@ -18,6 +18,7 @@ from django.urls import path
 from django.views.generic import TemplateView
 from django.views.generic.base import RedirectView
 
+from frontend import api
 from frontend import views
 
 
@@ -27,7 +28,9 @@ urlpatterns = [
     path("blog/<slug:template>", views.DynamicTemplateView.as_view(), name="blog_page"),
     path("measures/", views.measures, name="measures"),
     path("measure/<slug:measure>", views.measure, name="measure"),
+    path("measure/<slug:measure>/charts", views.measure_charts, name="measure_charts"),
     path("practice/<path:practice>", views.practice, name="practice"),
+    path("charts/<slug:content_hash>.<slug:extension>", views.chart, name="chart"),
     path("about/", TemplateView.as_view(template_name="about.html"), name="about"),
     path(
         "info_governance/",
@@ -45,5 +48,18 @@ urlpatterns = [
         name="data_format",
     ),
     path("api/", RedirectView.as_view(pattern_name="data_format"), name="api"),
+    path("api/measures/", api.measures, name="api_measures"),
+    path(
+        "api/measures/<slug:measure>/charts/",
+        api.measure_charts,
+        name="api_measure_charts",
+    ),
+    path("api/groups/", api.groups, name="api_groups"),
+    path(
+        "api/practices/<path:practice>/charts/",
+        api.practice_charts,
+        name="api_practice_charts",
+    ),
+    path("api/search/", api.search, name="api_search"),
     path("admin/", admin.site.urls),
 ]